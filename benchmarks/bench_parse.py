@@ -0,0 +1,209 @@
+#!/opt/anaconda3/bin/python3
+
+# bench_parse.py - Micro-benchmark for betabrite.parse_text_message against the original if/elif parser.
+# Run from the repository root:  python benchmarks/bench_parse.py [--number N]
+#
+# Every corpus is checked for identical output first, so this doubles as a regression check for the tag table.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import re
+from betabrite import *
+
+################################################################################
+
+# The parser as it was before the tag table: regexes compiled per token, an elif chain per tag and string
+# concatenation for the text.  Kept verbatim (renamed) as the baseline.
+def legacy_parse_text_message(tokens):
+    animations = []
+    text = ''
+    mode = MODE_AUTO
+    color = TEXT_COLOR_AUTO
+    position = TEXT_POS_MIDDLE
+
+    # Tag regex
+    tagRegex = r"^\[[a-zA-Z0-9]{2,12}\]$"
+
+    # String replacement tag regex ([strd] for string d, [str3] for string 3, etc.)
+    strTagRegex = r"^\[str.\]$"
+
+    for tok in tokens:
+        if len(tok) == 0:
+            continue
+
+        if re.match(tagRegex, tok):
+            if text != '' and not re.match(strTagRegex, tok):
+                animations.append(animation(text, mode, color, position))
+                text = ''
+                mode = MODE_AUTO
+                color = TEXT_COLOR_AUTO
+                position = TEXT_POS_MIDDLE
+
+            # TJBChris - original (though newly-reformatted) tags which manage mode, color, and position are grouped first.
+            # In Adaptive's protocol, these must come before any text or substitutions (time, date, temp., etc.)
+            if tok == '[middle]':
+                position = TEXT_POS_MIDDLE
+            elif tok == '[top]':
+                position = TEXT_POS_TOP
+            elif tok == '[bottom]':
+                position = TEXT_POS_BOTTOM
+            elif tok == '[fill]':
+                position = TEXT_POS_FILL
+            elif tok == '[red]':
+                color = TEXT_COLOR_RED
+            elif tok == '[green]':
+                color = TEXT_COLOR_GREEN
+            elif tok == '[amber]':
+                color = TEXT_COLOR_AMBER
+            elif tok == '[dimred]':
+                color = TEXT_COLOR_DIMRED
+            elif tok == '[brown]':
+                color = TEXT_COLOR_BROWN
+            elif tok == '[orange]':
+                color = TEXT_COLOR_ORANGE
+            elif tok == '[yellow]':
+                color = TEXT_COLOR_YELLOW
+            elif tok == '[rainbow1]':
+                color = TEXT_COLOR_RAINBOW1
+            elif tok == '[rainbow2]':
+                color = TEXT_COLOR_RAINBOW2
+            elif tok == '[mix]':
+                color = TEXT_COLOR_MIX
+            elif tok == '[autocolor]':
+                color = TEXT_COLOR_AUTO
+            elif tok == '[rotate]':
+                mode = MODE_ROTATE
+            elif tok == '[hold]':
+                mode = MODE_HOLD
+            elif tok == '[flash]':
+                mode = MODE_FLASH
+            elif tok == '[rollup]':
+                mode = MODE_ROLLUP
+            elif tok == '[rolldown]':
+                mode = MODE_ROLLDOWN
+            elif tok == '[rollleft]':
+                mode = MODE_ROLLLEFT
+            elif tok == '[rollright]':
+                mode = MODE_ROLLRIGHT
+            elif tok == '[wipeup]':
+                mode = MODE_WIPEUP
+            elif tok == '[wipedown]':
+                mode = MODE_WIPEDOWN
+            elif tok == '[wipeleft]':
+                mode = MODE_WIPELEFT
+            elif tok == '[wiperight]':
+                mode = MODE_WIPERIGHT
+            elif tok == '[scroll]':
+                mode = MODE_SCROLL
+            elif tok == '[automode]':
+                mode = MODE_AUTO
+            elif tok == '[rollin]':
+                mode = MODE_ROLLIN
+            elif tok == '[rollout]':
+                mode = MODE_ROLLOUT
+            elif tok == '[wipein]':
+                mode = MODE_WIPEIN
+            elif tok == '[wipeout]':
+                mode = MODE_WIPEOUT
+            elif tok == '[cmprsrot]':
+                mode = MODE_CMPRSROT
+            elif tok == '[twinkle]':
+                mode = MODE_TWINKLE
+            elif tok == '[sparkle]':
+                mode = MODE_SPARKLE
+            elif tok == '[snow]':
+                mode = MODE_SNOW
+            elif tok == '[interlock]':
+                mode = MODE_INTERLOCK
+            elif tok == '[switch]':
+                mode = MODE_SWITCH
+            elif tok == '[spray]':
+                mode = MODE_SPRAY
+            elif tok == '[starburst]':
+                mode = MODE_STARBURST
+            elif tok == '[welcome]':
+                mode = MODE_WELCOME
+            elif tok == '[slotmachine]':
+                mode = MODE_SLOTMACHINE
+            elif tok == '[newsflash]':
+                mode = MODE_NEWSFLASH
+            elif tok == '[trumpet]':
+                mode = MODE_TRUMPET
+            elif tok == '[thankyou]':
+                mode = MODE_THANKYOU
+            elif tok == '[nosmoking]':
+                mode = MODE_NOSMOKING
+            elif tok == '[drinkdrive]':
+                mode = MODE_DRINKDRIVE
+            elif tok == '[animal]':
+                mode = MODE_ANIMAL
+            elif tok == '[fish]':
+                mode = MODE_FISH
+            elif tok == '[fireworks]':
+                mode = MODE_FIREWORKS
+            elif tok == '[turbocar]':
+                mode = MODE_TURBOCAR
+            elif tok == '[balloons]':
+                mode = MODE_BALLOONS
+            elif tok == '[cherrybomb]':
+                mode = MODE_CHERRYBOMB
+
+            # TJBChris - Additional color/mode/position tags as they are needed.
+            elif tok == '[blue]':
+                color = TEXT_COLOR_BLUE
+
+            # TJBChris - In-text replacement tags start here (time, date, string substitutions, etc.); the result of these must replace the tag text.
+            elif tok == '[time]':
+                text += CURTIME_INSERT.decode()
+            elif tok == '[usdate]':
+                text += CURDATE_MMDDYY_SLASH.decode()
+            elif tok == '[timeday]':
+                text += CURDATE_WEEKDAYY.decode() + ' ' + CURTIME_INSERT.decode()
+            # Insert STRING value.
+            elif re.match(strTagRegex, tok):
+                text += STRING_FILE_INSERT.decode() + tok[4]
+
+        else:
+            if len(text) > 0:
+                text += ' '
+            text += tok
+
+    animations.append(animation(text, mode, color, position))
+
+    return animations
+
+
+################################################################################
+
+CORPORA = {
+    'short ticker': "[green] [rotate] Hello from TJBChris [rotate]".split(' '),
+    'readme B': "[red] [rolldown] It is now... [hold] [rollup] [green] [time] [rotate] [amber] The date is...    [rollright] [blue] [usdate] [hold]".split(' '),
+    'string insert': "[amber] [rotate] This is message C with string A: [str1] [rotate]".split(' '),
+    'late tags': ("[blue] [cherrybomb] [str9] [balloons] [timeday] " * 40).split(' '),
+    'long multi-segment': (" ".join("[%s] [%s] Segment %d has a fair amount of text in it, like a real ticker would. [str%d]" % (color, mode, i, i % 10) for (i, (color, mode)) in enumerate([('red', 'rotate'), ('green', 'hold'), ('amber', 'wipein'), ('blue', 'rollup')] * 50))).split(' '),
+    'long single segment': ("[green] [rotate] " + "word " * 5000 + "[hold]").split(' '),
+}
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", help="Parses per corpus per parser.  Default is 200.", type=int, default=200)
+    args = parser.parse_args()
+
+    for (name, tokens) in CORPORA.items():
+        if parse_text_message(tokens) != legacy_parse_text_message(tokens):
+            raise Exception("Parser output differs from the original for corpus: " + name)
+
+    print("%-22s %12s %12s %8s" % ("corpus", "original us", "table us", "speedup"))
+    for (name, tokens) in CORPORA.items():
+        old = min(timeit.repeat(lambda: legacy_parse_text_message(tokens), number=args.number, repeat=3)) / args.number
+        new = min(timeit.repeat(lambda: parse_text_message(tokens), number=args.number, repeat=3)) / args.number
+        print("%-22s %12.1f %12.1f %7.1fx" % (name, old * 1e6, new * 1e6, old / new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/opt/anaconda3/bin/python3
+
+# bench_startup.py - Start-up cost of betabrite: importing it as a library, and the encode-only CLI (--emit).
+# Run from the repository root:  python benchmarks/bench_startup.py [--number N]
+#
+# Each case runs in a fresh interpreter; the bare interpreter is timed too, so the difference is what betabrite
+# itself costs.  Also checks that neither case loads pyusb, since that import was most of the old start-up time.
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(ROOT, 'betabrite.py')
+
+CASES = [
+    ('interpreter', [sys.executable, '-c', 'pass']),
+    ('import betabrite', [sys.executable, '-c', 'import betabrite']),
+    ('--emit hex', [sys.executable, SCRIPT, '--emit', 'hex', '--label', 'A', '[red] [rotate] Hello from TJBChris']),
+]
+
+# Modules that should not be imported just to encode.
+HEAVY_MODULES = ['usb', 'hashlib', 'argparse']
+
+def run(cmd, env):
+    start = time.perf_counter()
+    subprocess.run(cmd, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", help="Runs per case (the best is reported).  Default is 20.", type=int, default=20)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    check = "import sys, betabrite; print(' '.join(m for m in %r if m in sys.modules))" % (HEAVY_MODULES,)
+    loaded = subprocess.run([sys.executable, '-c', check], env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    if loaded:
+        raise Exception("Importing betabrite loaded: " + loaded)
+
+    print("%-20s %10s %10s" % ("case", "best ms", "extra ms"))
+    baseline = None
+    for (name, cmd) in CASES:
+        best = min(run(cmd, env) for i in range(args.number))
+        if baseline is None:
+            baseline = best
+        print("%-20s %10.1f %10.1f" % (name, best * 1e3, (best - baseline) * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/opt/anaconda3/bin/python3
+
+# bench_suite.py - Benchmarks for the whole path from tags to the wire: parsing, encoding, framing and
+# transmission through a mock USB OUT endpoint.
+# Run from the repository root:  python benchmarks/bench_suite.py [--save FILE] [--baseline FILE]
+#
+# For each case and corpus it reports time per call, throughput, and for one call (from tracemalloc) the peak memory
+# allocated and the number of memory blocks its result holds.  The transmit cases also report how many writes reached the endpoint and the simulated
+# wire time at the default pacing and at a calibrated one (see PacingProfile), without actually sleeping.
+#
+# --save writes the results as JSON; --baseline compares against a saved run and exits with status 1 if any
+# case got slower by more than --tolerance (default 25%).
+
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from betabrite import *
+
+################################################################################
+
+# A stand-in for UsbTransport that keeps the size and time of every write instead of sending it.
+class MockEndpoint:
+
+    errors = (OSError,)
+
+    def __init__(self):
+        self.writes = []
+        self.opened = False
+
+    def is_open(self):
+        return self.opened
+
+    def open(self):
+        self.opened = True
+
+    def write(self, data):
+        self.writes.append((len(data), time.perf_counter()))
+
+    def read(self, size, timeout):
+        return b''
+
+    def close(self):
+        self.opened = False
+
+    def sent(self):
+        return sum(n for (n, t) in self.writes)
+
+# Wire time a packet of n bytes would take under a pacing profile: the pacing delays plus the per-write cost
+# (PACING_WRITE_COST).
+def simulated_wire_time(n, profile):
+    return profile.cost(n)
+
+################################################################################
+
+def ticker_tokens():
+    return "[green] [rotate] Hello from TJBChris [rotate]".split(' ')
+
+def multi_segment_tokens():
+    return (" ".join("[%s] [%s] Segment %d has a fair amount of text in it, like a real ticker would. [str%d] [time]" % (color, mode, i, i % 10) for (i, (color, mode)) in enumerate([('red', 'rotate'), ('green', 'hold'), ('amber', 'wipein'), ('blue', 'rollup')] * 50))).split(' ')
+
+# Fills a TEXT label to just under the sign's 64K limit.
+def big_label_tokens():
+    return ["[green]", "[rotate]"] + ["0123456789abcdef" * 4] * 1000
+
+def manifest():
+    labels = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return {
+        'memory': ["t[%s,512]" % l for l in labels] + ["s[%d,32]" % i for i in range(1, 10)],
+        'strings': dict((str(i), "value %d" % i) for i in range(1, 10)),
+        'texts': dict((l, "[red] [rotate] Message %s: [str%d] and the time is [time] [hold] [green] Done." % (l, i % 9 + 1)) for (i, l) in enumerate(labels)),
+        'sequence': "SU" + labels,
+        'clock': {'time': "12:00", 'date': "01/01/26", 'day': "1"},
+    }
+
+def accented_tokens():
+    return ("[amber] [hold] Crème brûlée à la façon de Noël, 21°C – “très bon” ½ prix " * 20).split(' ')
+
+CORPORA = {
+    'short ticker': ticker_tokens(),
+    'accented': accented_tokens(),
+    'multi-segment': multi_segment_tokens(),
+    '64K label': big_label_tokens(),
+}
+
+def encode(tokens):
+    return write_file(parse_text_message(tokens), b"A")
+
+def transmit_through(payloads, chunkSize):
+    endpoint = MockEndpoint()
+    conn = SignConnection(endpoint, pacing=PacingProfile(chunkSize, 0), name='mock')
+    transmit_batch(payloads, conn=conn)
+    return endpoint
+
+################################################################################
+
+# Only blocks allocated by betabrite itself are counted, not the benchmark's or tracemalloc's own.
+BETABRITE_FILTER = tracemalloc.Filter(True, sys.modules['betabrite'].__file__)
+
+# Peak memory (bytes) of one call of fn, and how many blocks betabrite allocated in it that are still held once it
+# returns (its result, plus anything it cached).
+def traced_call(fn):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces([BETABRITE_FILTER])
+    value = fn()
+    (current, peak) = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces([BETABRITE_FILTER])
+    tracemalloc.stop()
+    del value
+    return (peak, sum(stat.count_diff for stat in after.compare_to(before, 'filename')))
+
+# Times fn (best of 3 runs of as many calls as fill ~0.2 s) and measures the memory of one call (see traced_call).
+def measure(fn, size=None):
+    timer = timeit.Timer(fn)
+    (number, elapsed) = timer.autorange()
+    best = min([elapsed] + timer.repeat(repeat=2, number=number)) / number
+
+    (peak, blocks) = traced_call(fn)
+    result = {'seconds': best, 'peak_kb': peak / 1024.0, 'blocks': blocks}
+    if size is not None:
+        result['mb_per_second'] = size / best / 1e6
+    return result
+
+def run_cases():
+    results = {}
+    for (name, tokens) in CORPORA.items():
+        text = ' '.join(tokens)
+        payload = encode(tokens)
+        results['parse/' + name] = measure(lambda: parse_text_message(tokens), len(text))
+        results['encode/' + name] = measure(lambda: encode(tokens), len(payload))
+        results['transcode/' + name] = measure(lambda: transcode(text), len(text))
+        results['frame/' + name] = measure(lambda: frame([payload]), len(payload))
+        for chunkSize in (1, 64):
+            case = 'transmit %dB/%s' % (chunkSize, name)
+            results[case] = measure(lambda: transmit_through([payload], chunkSize), len(payload))
+            endpoint = transmit_through([payload], chunkSize)
+            results[case]['writes'] = len(endpoint.writes)
+            results[case]['wire_default'] = simulated_wire_time(endpoint.sent(), PacingProfile())
+            results[case]['wire_calibrated'] = simulated_wire_time(endpoint.sent(), PacingProfile(chunkSize, 0.0001))
+
+    specs = manifest()['memory']
+    results['config_mem/full sign'] = measure(lambda: config_mem('cfgmem', specs))
+    results['manifest/full sign'] = measure(lambda: compile_manifest(manifest()))
+    payloads = compile_manifest(manifest())
+    results['transmit 64B/full sign'] = measure(lambda: transmit_through(payloads, 64), sum(payload_len(p) for p in payloads))
+    endpoint = transmit_through(payloads, 64)
+    results['transmit 64B/full sign']['writes'] = len(endpoint.writes)
+    results['transmit 64B/full sign']['wire_default'] = simulated_wire_time(endpoint.sent(), PacingProfile())
+    results['transmit 64B/full sign']['wire_calibrated'] = simulated_wire_time(endpoint.sent(), PacingProfile(64, 0.0001))
+    return results
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", help="Writes the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compares against results saved earlier with --save.")
+    parser.add_argument("--tolerance", help="With --baseline, the slowdown that counts as a regression.  Default is 0.25 (25%%).", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run_cases()
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+
+    print("%-34s %11s %9s %9s %7s %7s %10s %10s %8s" % ("case", "us/call", "MB/s", "peak KB", "blocks", "writes", "wire dflt", "wire cal", "vs base"))
+    regressions = []
+    for (case, r) in results.items():
+        change = ''
+        if baseline is not None and case in baseline:
+            ratio = r['seconds'] / baseline[case]['seconds']
+            change = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + args.tolerance:
+                regressions.append(case)
+        print("%-34s %11.1f %9s %9.1f %7d %7s %10s %10s %8s" % (case, r['seconds'] * 1e6,
+            "%.1f" % r['mb_per_second'] if 'mb_per_second' in r else '', r['peak_kb'], r['blocks'],
+            r.get('writes', ''), "%.2fs" % r['wire_default'] if 'wire_default' in r else '',
+            "%.2fs" % r['wire_calibrated'] if 'wire_calibrated' in r else '', change))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print("Slower than the baseline by more than %d%%: %s" % (args.tolerance * 100, ", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
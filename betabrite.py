@@ -7,11 +7,19 @@
 # This script requires Python > 3.12 (it works with 3.11.5).
 
 import time
-import usb.core
-import usb.util
 import re
 import sys
-import usb.backend.libusb1
+import os
+import json
+import mmap
+import collections
+import threading
+import heapq
+import itertools
+
+# TJBChris - pyusb (and hashlib, which loads OpenSSL) are imported when first needed rather than here.  They were
+# most of the time it took to import this module, and encoding a message (--emit, or library use) needs neither.
+# See import_usb().
 
 # TJBChris commeted for USB-based BetaBrite PRISM sign.
 #import serial
@@ -408,65 +416,1595 @@ SET_DATE             = b"\x3b";     # SPEC_FUNC - Set Date
 SET_DAY              = b"\x26";     # SPEC_FUNC - Set Day of Week
 SET_SEQUENCE         = b"\x2e";     # SPEC_FUNC - Set Message Sequence
 SET_MEM_CONFIG       = b"\x24";     # SPEC_FUNC - Clear/Set Memory Config ($)
+SET_COUNTER          = b"\x35";     # SPEC_FUNC - Set Counter (5)
 
 ################################################################################
 
+# USB BetaBrite PRISM - All have the same Vendor ID and Product ID.
+PRISM_VENDOR_ID      = 0x8765
+PRISM_PRODUCT_ID     = 0x1234
+
+# Where saved state (pacing profile, etc.) lives.  Override with BETABRITE_HOME.
+BETABRITE_HOME       = os.environ.get('BETABRITE_HOME', os.path.join(os.path.expanduser('~'), '.betabrite'))
+
+# Unix domain socket the resident daemon (--daemon) listens on.  Override with BETABRITE_SOCKET.
+DAEMON_SOCKET        = os.environ.get('BETABRITE_SOCKET', '/tmp/betabrite.sock')
+
+def state_path(name):
+    return os.path.join(BETABRITE_HOME, name)
+
+def load_state(name, default=None):
+    try:
+        with open(state_path(name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, data):
+    os.makedirs(BETABRITE_HOME, exist_ok=True)
+    tmpPath = state_path(name) + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmpPath, state_path(name))
+
+# TJBChris - Instrumentation.  Every phase of getting bytes to a sign is timed (finding the USB device, setting its
+# configuration, looking up endpoints, each packet write, each read) and counted (bytes, packets, commands by type
+# and label, retries, failures), labelled by sign.  Everything goes into the module-wide METRICS, which can be
+# written out as a Prometheus text file (for node_exporter's textfile collector) or as JSON lines; see --metrics.
+#
+# Tracing hooks get every finished span as it happens, for whatever tracing system you use:
+#
+#   METRICS.add_hook(lambda name, seconds, labels, error: print(name, seconds, labels, error))
+#
+# Counters are named *_total; spans are kept as a count, sum and max of seconds, named *_seconds.
+METRICS_PREFIX       = 'betabrite_'
+
+class _Span:
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, excValue, **self.labels)
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.hooks = []
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Records one timed phase and passes it on to the tracing hooks.  error is the exception it ended with, if any.
+    def observe(self, name, seconds, error=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook(name, seconds, labels, error)
+
+    # Times a with block:  with METRICS.span('write', sign='usb'): ...
+    def span(self, name, **labels):
+        return _Span(self, name, labels)
+
+    # (count, total seconds, longest) for one series, or None if it hasn't been observed.
+    def timer(self, name, **labels):
+        with self.lock:
+            timer = self.timers.get((name, tuple(sorted(labels.items()))))
+            return tuple(timer) if timer is not None else None
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def add_hook(self, hook):
+        with self.lock:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self.lock:
+            self.hooks.remove(hook)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    # All series as dicts: {'metric', 'labels', 'value'} for counters and {'metric', 'labels', 'count', 'sum',
+    # 'max'} for spans.  Bytes per second while writing is derived per sign from the bytes and write time.
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict((key, list(value)) for (key, value) in self.timers.items())
+
+        series = []
+        for ((name, labels), value) in sorted(counters.items()):
+            series.append({'metric': name + '_total', 'labels': dict(labels), 'value': value})
+        for ((name, labels), (count, total, longest)) in sorted(timers.items()):
+            series.append({'metric': name + '_seconds', 'labels': dict(labels), 'count': count, 'sum': total, 'max': longest})
+            if name == 'write':
+                sent = counters.get(('bytes_sent', labels), 0)
+                series.append({'metric': 'write_bytes_per_second', 'labels': dict(labels), 'value': sent / total if total > 0 else 0.0})
+        return series
+
+    def prometheus(self):
+        def labelText(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in sorted(labels.items())) + '}'
+
+        # Series are grouped by family, and each span's max is a gauge family of its own, as Prometheus expects.
+        families = collections.OrderedDict()
+        def add(name, kind, line):
+            families.setdefault(name, (kind, []))[1].append(line)
+
+        for s in self.snapshot():
+            name = METRICS_PREFIX + s['metric']
+            labels = labelText(s['labels'])
+            if 'count' in s:
+                add(name, 'summary', '%s_count%s %d' % (name, labels, s['count']))
+                add(name, 'summary', '%s_sum%s %.6f' % (name, labels, s['sum']))
+                add(name + '_max', 'gauge', '%s_max%s %.6f' % (name, labels, s['max']))
+            else:
+                add(name, 'counter' if s['metric'].endswith('_total') else 'gauge', '%s%s %s' % (name, labels, s['value']))
+
+        lines = []
+        for (name, (kind, samples)) in families.items():
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines += samples
+        return '\n'.join(lines) + '\n'
+
+    def json_lines(self):
+        now = time.time()
+        return ''.join(json.dumps(dict(s, time=now), sort_keys=True) + '\n' for s in self.snapshot())
+
+    # Writes the metrics to path: Prometheus text if it ends in .prom (replacing the file), otherwise JSON lines
+    # (appended, so the file keeps a history).
+    def write(self, path):
+        if path.endswith('.prom'):
+            tmpPath = path + '.tmp'
+            with open(tmpPath, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmpPath, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(self.json_lines())
+
+METRICS = Metrics()
+
+# TJBChris - Pacing: how many bytes go into each write and how long we wait between writes.  The sign overruns
+# if we feed it too quickly, so the default is the original one-byte-per-millisecond kludge, which works
+# everywhere but is slow.  Run --calibrate to find (and save) the fastest profile your sign accepts.
+PACING_FILE          = 'pacing.json'
+PACING_CHUNK_SIZES   = [1, 2, 4, 8, 16, 32, 64]
+PACING_DELAYS        = [0.001, 0.0005, 0.0002, 0.0001, 0]
+PACING_WRITE_COST    = 0.000125     # Seconds per write call: a USB bulk transfer on a full-speed bus, typically
+
+class PacingProfile:
+
+    def __init__(self, chunkSize=1, delay=0.001):
+        if chunkSize < 1:
+            raise Exception("Pacing chunk size must be at least 1 byte.  Got: " + str(chunkSize))
+        if delay < 0:
+            raise Exception("Pacing delay cannot be negative.  Got: " + str(delay))
+        self.chunkSize = chunkSize
+        self.delay = delay
+
+    def __repr__(self):
+        return "PacingProfile(chunkSize=%d, delay=%g)" % (self.chunkSize, self.delay)
+
+    # Rough wire time for a packet of n bytes, ignoring the time spent in the write calls themselves.
+    def estimate(self, n):
+        return -(-n // self.chunkSize) * self.delay
+
+    # Same, plus PACING_WRITE_COST for every write.  Without it every zero-delay profile would look free.
+    def cost(self, n):
+        return self.estimate(n) + -(-n // self.chunkSize) * PACING_WRITE_COST
+
+    def to_dict(self):
+        return {'chunkSize': self.chunkSize, 'delay': self.delay}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(int(d['chunkSize']), float(d['delay']))
+
+    @classmethod
+    def load(cls, name=PACING_FILE):
+        d = load_state(name)
+        if d is None:
+            return cls()
+        try:
+            return cls.from_dict(d)
+        except (KeyError, TypeError, ValueError):
+            return cls()
+
+    def save(self, name=PACING_FILE):
+        save_state(name, self.to_dict())
+
+# TJBChris - Transports.  Each one knows how to open, write to and close one kind of link to a sign; pacing,
+# batching and connection reuse live in SignConnection and work the same over all of them.  A transport lists
+# the exceptions that mean "the link went stale" in .errors, so SignConnection knows when to reconnect.
+#
+# Transport specs (--port, or open_transport()):
+#   usb                         the BetaBrite PRISM on USB (default)
+#   usb:path=1-2.3              the PRISM plugged into bus 1, port 2.3 (see --list-signs)
+#   usb:serial=XXXX             the PRISM with that serial number
+#   serial:/dev/ttyUSB0[@9600]  RS-232 (requires pyserial)
+#   tcp:host:port               a serial-to-Ethernet adapter or anything else speaking raw TCP
+#   file:path                   appends every frame, byte for byte, to a file or pipe ('file:-' is stdout)
+DEFAULT_PORT         = os.environ.get('BETABRITE_PORT', 'usb')
+SERIAL_BAUDRATE      = 9600
+READ_TIMEOUT         = 2.0          # Seconds to wait for the sign to answer a read command
+READ_SIZE            = 64           # Bytes to ask the transport for per read
+
+# Imports pyusb and its libusb backend on first use, so that only a USB sign needs pyusb installed (or loaded).
+def import_usb():
+    global usb
+    try:
+        import usb.core
+        import usb.util
+        import usb.backend.libusb1
+    except ImportError:
+        raise Exception("The USB transport requires pyusb.  For anaconda, run: conda install -c conda-forge pyusb")
+    return usb
+
+# TJBChris - Every PRISM has the same vendor and product ID, so with more than one on the bus we pick one by
+# where it's plugged in (bus-port path, e.g. "1-2.3", as shown by --list-signs) or by its serial number.  With
+# neither, the first one found is used.
+def usb_path(dev):
+    return "%d-%s" % (dev.bus, ".".join(str(p) for p in (dev.port_numbers or ())))
+
+def usb_serial(dev):
+    try:
+        return dev.serial_number
+    except (usb.core.USBError, ValueError, NotImplementedError):
+        return None
+
+# Lists the PRISMs on the bus, each as a dict with its path, serial number (None if unreadable) and the
+# transport spec that selects it.
+def find_signs(idVendor=PRISM_VENDOR_ID, idProduct=PRISM_PRODUCT_ID):
+    import_usb()
+    signs = []
+    for dev in usb.core.find(find_all=True, idVendor=idVendor, idProduct=idProduct, backend=usb.backend.libusb1.get_backend()):
+        path = usb_path(dev)
+        signs.append({'path': path, 'serial': usb_serial(dev), 'port': 'usb:path=' + path})
+    return signs
+
+class UsbTransport:
+
+    def __init__(self, idVendor=PRISM_VENDOR_ID, idProduct=PRISM_PRODUCT_ID, path=None, serial=None):
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.path = path
+        self.serial = serial
+        self.dev = None
+        self.ep = None
+        self.epIn = None
+
+    # Looked up when an error is being matched, by which time open() has imported pyusb.
+    @property
+    def errors(self):
+        return (import_usb().core.USBError,)
+
+    def is_open(self):
+        return self.ep is not None
+
+    def open(self):
+        with METRICS.span('usb_import'):
+            import_usb()
+
+        # Find the BetaBrite PRISM
+        with METRICS.span('usb_find'):
+            if self.path is None and self.serial is None:
+                dev = usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct, backend=usb.backend.libusb1.get_backend())
+            else:
+                dev = usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct, backend=usb.backend.libusb1.get_backend(),
+                    custom_match = lambda d: (self.path is None or usb_path(d) == self.path) and (self.serial is None or usb_serial(d) == self.serial))
+
+        # was it found?
+        if dev is None:
+            raise ValueError('BetaBrite PRISM device not found.' + (' (path=%s serial=%s)' % (self.path, self.serial) if self.path or self.serial else ''))
+
+        # set the active configuration. With no arguments, the first
+        # configuration will be the active one
+        with METRICS.span('usb_set_configuration'):
+            dev.set_configuration()
+
+        with METRICS.span('usb_endpoints'):
+            # get an endpoint instance
+            cfg = dev.get_active_configuration()
+            intf = cfg[(0,0)]
+
+            ep = usb.util.find_descriptor(
+                intf,
+                # match the first OUT endpoint
+                custom_match = \
+                lambda e: \
+                    usb.util.endpoint_direction(e.bEndpointAddress) == \
+                    usb.util.ENDPOINT_OUT)
+
+            assert ep is not None
+
+            # The IN endpoint carries the sign's replies to read commands.
+            epIn = usb.util.find_descriptor(
+                intf,
+                custom_match = \
+                lambda e: \
+                    usb.util.endpoint_direction(e.bEndpointAddress) == \
+                    usb.util.ENDPOINT_IN)
+
+        self.dev = dev
+        self.ep = ep
+        self.epIn = epIn
+
+    def write(self, data):
+        self.ep.write(data)
+
+    # Returns whatever arrives within timeout seconds (up to size bytes), or b'' if nothing does.
+    def read(self, size, timeout):
+        if self.epIn is None:
+            raise Exception("This sign has no USB IN endpoint; it can't answer read commands.")
+        try:
+            return bytes(self.epIn.read(max(size, self.epIn.wMaxPacketSize), int(timeout * 1000)))
+        except usb.core.USBTimeoutError:
+            return b''
+
+    def close(self):
+        if self.dev is not None:
+            usb.util.dispose_resources(self.dev)
+        self.dev = None
+        self.ep = None
+        self.epIn = None
+
+class SerialTransport:
+
+    def __init__(self, port, baudrate=SERIAL_BAUDRATE):
+        # pyserial is only needed for serial signs.
+        try:
+            import serial
+        except ImportError:
+            raise Exception("The serial transport requires pyserial.  For anaconda, run: conda install -c conda-forge pyserial")
+
+        self.serial = serial
+        self.port = port
+        self.baudrate = baudrate
+        self.errors = (serial.SerialException, OSError)
+        self.ser = None
+
+    def is_open(self):
+        return self.ser is not None
+
+    def open(self):
+        self.ser = self.serial.Serial(self.port, self.baudrate, timeout=10)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def read(self, size, timeout):
+        self.ser.timeout = timeout
+        return self.ser.read(size)
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+        self.ser = None
+
+class TcpTransport:
+
+    def __init__(self, host, port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.errors = (OSError,)
+        self.sock = None
+
+    def is_open(self):
+        return self.sock is not None
+
+    def open(self):
+        import socket
+
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def read(self, size, timeout):
+        import socket
+
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(size)
+        except socket.timeout:
+            return b''
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+# Records frames exactly as they'd go on the wire.  Useful for testing without a sign, or for replaying later
+# (e.g. cat capture.bin > /dev/ttyUSB0).
+class FileTransport:
+
+    def __init__(self, path):
+        self.path = path
+        self.errors = (OSError,)
+        self.f = None
+
+    def is_open(self):
+        return self.f is not None
+
+    def open(self):
+        if self.path == '-':
+            self.f = sys.stdout.buffer
+        else:
+            self.f = open(self.path, 'ab')
+
+    def write(self, data):
+        self.f.write(data)
+
+    # Called after each packet, so a capture or pipe sees every frame as it's sent, not when the link closes.
+    def flush(self):
+        self.f.flush()
+
+    def read(self, size, timeout):
+        raise Exception("The file transport only records frames; it can't read anything back from a sign.")
+
+    def close(self):
+        if self.f is not None:
+            self.f.flush()
+            if self.f is not sys.stdout.buffer:
+                self.f.close()
+        self.f = None
+
+def open_transport(spec=DEFAULT_PORT):
+    (kind, sep, target) = spec.partition(':')
+
+    if kind == 'usb':
+        (key, sep, value) = target.partition('=')
+        if target == '':
+            return UsbTransport()
+        elif key == 'path':
+            return UsbTransport(path=value)
+        elif key == 'serial':
+            return UsbTransport(serial=value)
+        raise Exception("USB transport takes path=BUS-PORTS or serial=SERIAL, e.g. usb:path=1-2.3.  Got: " + spec)
+
+    elif kind == 'serial':
+        (port, sep, baudrate) = target.partition('@')
+        if port == '':
+            raise Exception("Serial transport needs a port, e.g. serial:/dev/ttyUSB0 or serial:/dev/ttyUSB0@9600.  Got: " + spec)
+        return SerialTransport(port, int(baudrate) if baudrate != '' else SERIAL_BAUDRATE)
+
+    elif kind == 'tcp':
+        (host, sep, port) = target.rpartition(':')
+        if host == '' or not port.isdigit():
+            raise Exception("TCP transport needs a host and port, e.g. tcp:10.0.0.5:10001.  Got: " + spec)
+        return TcpTransport(host, int(port))
+
+    elif kind == 'file':
+        if target == '':
+            raise Exception("File transport needs a path ('-' for stdout), e.g. file:capture.bin.  Got: " + spec)
+        return FileTransport(target)
+
+    else:
+        raise Exception("Unknown transport '" + kind + "'.  Use usb, serial:PORT[@BAUD], tcp:HOST:PORT or file:PATH.")
+
+# TJBChris - Sign registry.  Gives each sign a stable name, so scripts can say --sign lobby instead of tracking
+# which USB port or serial adapter it's on this week.  Stored in signs.json as name -> {port, addr}.
+SIGNS_FILE           = 'signs.json'
+
+SignTarget = collections.namedtuple('SignTarget', ['name', 'port', 'addr'])
+
+def load_signs():
+    signs = {}
+    for (name, d) in load_state(SIGNS_FILE, {}).items():
+        signs[name] = SignTarget(name, d['port'], bytes(d.get('addr', '00'), 'latin-1'))
+    return signs
+
+def register_sign(name, port, addr=SIGN_ADDRESS_BROADCAST):
+    if name == 'all':
+        raise Exception("'all' is reserved; it means every registered sign.")
+    data = load_state(SIGNS_FILE, {})
+    data[name] = {'port': port, 'addr': addr.decode('latin-1')}
+    save_state(SIGNS_FILE, data)
+
+# Looks up sign names ('all' for every registered sign) and returns their SignTargets in order.
+def resolve_signs(names):
+    signs = load_signs()
+    targets = []
+    for name in names:
+        if name == 'all':
+            targets += [s for s in signs.values() if s not in targets]
+        elif name in signs:
+            if signs[name] not in targets:
+                targets.append(signs[name])
+        else:
+            raise Exception("Unknown sign '" + name + "'.  Register it first with --register " + name + " --port ...")
+    if len(targets) == 0:
+        raise Exception("No signs registered.")
+    return targets
+
+# Raised by a preemptible write that was cut short (see SignConnection.write).  sent is how many bytes of the
+# packet made it out before the EOT that closed it.
+class Preempted(Exception):
+
+    def __init__(self, sent):
+        Exception.__init__(self, "Transmission preempted after %d bytes." % sent)
+        self.sent = sent
+
+# TJBChris - Holds the link to a sign open between transmissions.  For USB, finding the device, setting its
+# configuration and looking up the OUT endpoint is a full bus enumeration plus a configuration reset, so we only
+# do it once and keep the endpoint handle around.  If a write fails, we drop the link, reconnect, and try the
+# packet again.
+class SignConnection:
+
+    def __init__(self, transport=None, retries=1, pacing=None, name='usb'):
+        self.transport = transport if transport is not None else UsbTransport()
+        self.retries = retries
+        self.pacing = pacing if pacing is not None else PacingProfile.load()
+        # What the connection's metrics are labelled with (see Metrics); get_connection() uses the transport spec.
+        self.name = name
+        # Held for a whole packet (or a command and its reply), so threads sharing a connection never interleave.
+        self.lock = threading.RLock()
+        # Set (by another thread) to cut short the preemptible write in progress.
+        self.preempt = threading.Event()
+
+    def open(self):
+        if not self.transport.is_open():
+            with METRICS.span('open', sign=self.name):
+                self.transport.open()
+        return self
+
+    def close(self):
+        self.transport.close()
+
+    def reconnect(self):
+        self.close()
+        return self.open()
+
+    # Transports that buffer (see FileTransport) have a flush(); the others write straight through.
+    def flush(self):
+        flush = getattr(self.transport, 'flush', None)
+        if flush is not None:
+            flush()
+
+    # Sends a complete packet, given as bytes or a list of pieces (see payload_pieces).  A failed write means the
+    # link went stale (sign power-cycled, cable pulled, etc.), so reconnect and resend the whole packet; a
+    # partial packet is useless to the sign anyway.
+    #
+    # A preemptible write checks self.preempt between chunks.  Once the header is out, any chunk boundary is a
+    # safe point: if preempt is set, we close the packet with EOT (so the sign isn't left waiting mid-frame),
+    # clear the flag and raise Preempted.  The caller decides what to do with the interrupted packet.
+    def write(self, packet, preemptible=False):
+        pieces = payload_pieces(packet)
+        attempt = 0
+        with self.lock:
+            while True:
+                try:
+                    self.open()
+                    with METRICS.span('write', sign=self.name):
+                        self._write_packet(pieces, preemptible)
+                        self.flush()
+                    METRICS.count('packets', sign=self.name)
+                    return
+                except self.transport.errors:
+                    self.close()
+                    if attempt >= self.retries:
+                        METRICS.count('write_failures', sign=self.name)
+                        raise
+                    METRICS.count('write_retries', sign=self.name)
+                    attempt += 1
+
+    def _write_packet(self, pieces, preemptible=False):
+        # The BetaBrite isn't very bright...faster systems tend to overrun the sign and it responds unpredictably.
+        # To slow the process down, we write in small chunks with a delay between each (see PacingProfile).
+        delay = self.pacing.delay
+        total = sum(memoryview(piece).nbytes for piece in pieces)
+        sent = 0
+        for chunk in iter_chunks(pieces, self.pacing.chunkSize):
+            if preemptible and sent >= FRAME_HEADER_LEN and sent < total - 1 and self.preempt.is_set():
+                self.preempt.clear()
+                self.transport.write(EOT)
+                METRICS.count('bytes_sent', sent + 1, sign=self.name)
+                METRICS.count('preempted', sign=self.name)
+                raise Preempted(sent)
+            self.transport.write(chunk)
+            sent += len(chunk)
+            if delay:
+                time.sleep(delay)
+        METRICS.count('bytes_sent', sent, sign=self.name)
+
+    # Reads one packet sent by the sign (a reply to a read command), up to and including its EOT.  Gives up after
+    # timeout seconds without one, returning whatever arrived.
+    def read_packet(self, timeout=READ_TIMEOUT):
+        self.open()
+        deadline = time.monotonic() + timeout
+        packet = b''
+        with METRICS.span('read', sign=self.name):
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    METRICS.count('read_timeouts', sign=self.name)
+                    return packet
+                packet += self.transport.read(READ_SIZE, remaining)
+                if SOH in packet and EOT in packet[packet.index(SOH):]:
+                    return packet
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+# Cuts a packet (a list of pieces) into chunkSize writes.  Chunks are cut straight out of the pieces with
+# memoryviews; only a chunk that straddles two pieces is copied (into a chunk-sized buffer).
+def iter_chunks(pieces, chunkSize):
+    pending = bytearray()
+
+    for piece in pieces:
+        view = memoryview(piece).cast('B')
+
+        if len(pending) > 0:
+            need = chunkSize - len(pending)
+            pending += view[:need]
+            view = view[need:]
+            if len(pending) < chunkSize:
+                continue
+            yield pending
+            pending = bytearray()
+
+        for i in range(0, len(view) - len(view) % chunkSize, chunkSize):
+            yield view[i:i+chunkSize]
+        pending += view[len(view) - len(view) % chunkSize:]
+
+    if len(pending) > 0:
+        yield pending
+
+# Connections shared by transmit() calls that don't supply their own, one per transport spec.  Opened on first use.
+_connections = {}
+
+def get_connection(spec=DEFAULT_PORT):
+    if spec not in _connections:
+        _connections[spec] = SignConnection(open_transport(spec), name=spec)
+    return _connections[spec]
+
 # Next commented to remove port reference.
 #def transmit(port, payload, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL_VERIFY):
 
-def transmit(payload, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL):
+def transmit(payload, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, conn=None, checksummed=False):
+    transmit_batch([payload], addr, type, conn, checksummed)
+
+# TJBChris - Builds the packet for one or more commands.  A single command gets the original framing; several
+# are nested as STX...ETX blocks inside one WAKEUP/SOH header (Alpha protocol "nested packets"), so a
+# multi-label refresh costs one wake-up instead of one per command.
+#
+# With checksummed=True, every command is closed with ETX and followed by its checksum (see checksum()), so the
+# sign can detect corruption and flag it in its serial error status register.
+def frame(payloads, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, checksummed=False):
+    return b''.join(iter_frame(payloads, addr, type, checksummed))
+
+# Same as frame(), but yields the packet piece by piece (header, each command's pieces, trailer) without ever
+# building it.  transmit_batch() feeds these straight to the paced writer.
+def iter_frame(payloads, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, checksummed=False):
+    if len(payloads) == 0:
+        raise Exception("At least one command is required to build a packet.")
+
+    yield WAKEUP + SOH + type + addr
+    if len(payloads) == 1 and not checksummed:
+        yield STX
+        yield from payload_pieces(payloads[0])
+    else:
+        for payload in payloads:
+            pieces = payload_pieces(payload)
+            yield STX
+            yield from pieces
+            yield ETX
+            if checksummed:
+                yield checksum_pieces([STX] + pieces + [ETX])
+    yield EOT
+
+# Bytes before the first command's data: WAKEUP, SOH, type, address, STX.
+FRAME_HEADER_LEN     = len(WAKEUP) + 1 + 1 + 2 + 1
+
+# Size of the packet frame() would build, without building it.
+def frame_len(payloads, checksummed=False):
+    if len(payloads) == 1 and not checksummed:
+        return len(WAKEUP) + 4 + 1 + payload_len(payloads[0]) + 1
+    perCommand = 2 + (4 if checksummed else 0)
+    return len(WAKEUP) + 4 + sum(payload_len(p) + perCommand for p in payloads) + 1
+
+# Alpha protocol checksum: four uppercase hex digits holding the 16-bit sum of every byte from STX through ETX.
+def checksum(data):
+    return b"%04X" % (sum(data) & 0xFFFF)
+
+def checksum_pieces(pieces):
+    return b"%04X" % (sum(sum(memoryview(piece).cast('B')) for piece in pieces) & 0xFFFF)
+
+# TJBChris - A payload (one command: code, label, data) is either bytes or a list of pieces (bytes, bytearray or
+# memoryview) that make up the command in order.  Large TEXT files travel as pieces so that they're never copied
+# into one big buffer on the way to the sign.
+def payload_pieces(payload):
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return [payload]
+    return list(payload)
+
+def payload_len(payload):
+    return sum(memoryview(piece).nbytes for piece in payload_pieces(payload))
+
+# The first n bytes of a payload (fewer if it's shorter), for looking at the command code and label.
+def payload_head(payload, n):
+    head = b''
+    for piece in payload_pieces(payload):
+        head += bytes(memoryview(piece).cast('B')[:n - len(head)])
+        if len(head) >= n:
+            break
+    return head
+
+def payload_digest(payload):
+    import hashlib
+    digest = hashlib.sha1()
+    for piece in payload_pieces(payload):
+        digest.update(piece)
+    return digest.hexdigest()
+
+def transmit_batch(payloads, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, conn=None, checksummed=False, preemptible=False):
 
     #print(payload)
-    packet = WAKEUP + SOH + type + addr + STX + payload + EOT
-    
-    # TJBChris commented out - USB follows.
-    #ser = serial.Serial(port, 9600, timeout=10)
-    #ser.write(packet)
-    #time.sleep(2)
-    #ser.close()
-
-    # Find the BetaBrite PRISM
-    dev = usb.core.find(idVendor=0x8765, idProduct=0x1234,backend=usb.backend.libusb1.get_backend())
-
-    # was it found?
-    if dev is None:
-        raise ValueError('BetaBrite PRISM device not found.')
-
-    # set the active configuration. With no arguments, the first
-    # configuration will be the active one
-    dev.set_configuration()
-
-    # get an endpoint instance
-    cfg = dev.get_active_configuration()
-    intf = cfg[(0,0)]
-
-    ep = usb.util.find_descriptor(
-        intf,
-        # match the first OUT endpoint
-        custom_match = \
-        lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_OUT)
-
-    assert ep is not None
-
-    # write the data
-    #print(packet)
-    #out = ep.write(packet)
-
-    # The BetaBrite isn't very bright...faster systems tend to overrun the sign and it responds unpredictably.
-    # To slow the process down, we insert a .01 second delay between each byte.  It's a kludge, but it fixes
-    # transmission on faster systems.
-    for i in range(0, len(packet), 1):
-        ep.write(packet[i:i+1])
-        time.sleep(0.001)
+    packet = list(iter_frame(payloads, addr, type, checksummed))
+
+    if conn is None:
+        conn = get_connection()
+    conn.write(packet, preemptible)
+    count_commands(payloads, conn.name)
+
+# The command type and label for a payload, for metric labels: ('text', 'A'), ('string', '1'), ('special', '$')...
+COMMAND_NAMES        = {b'A': 'text', b'B': 'read_text', b'E': 'special', b'F': 'read_special', b'G': 'string', b'H': 'read_string', b'I': 'dots', b'J': 'read_dots'}
+
+def payload_kind(payload):
+    head = payload_head(payload, 2)
+    return (COMMAND_NAMES.get(head[0:1], head[0:1].decode('latin-1')), head[1:2].decode('latin-1'))
+
+# Counts commands and their bytes by sign, command type and label (see payload_kind) once they've been sent.
+def count_commands(payloads, sign):
+    for payload in payloads:
+        (command, label) = payload_kind(payload)
+        METRICS.count('commands', sign=sign, command=command, label=label)
+        METRICS.count('command_bytes', payload_len(payload), sign=sign, command=command, label=label)
+
+# Collects the output of write_file, write_string, parse_function, config_mem, etc. and sends them all in one
+# packet, e.g.:
+#   batch = Batch()
+#   batch.add(write_string(["42"], "1"))
+#   batch.add(write_file(parse_text_message(["[red]", "Hello"]), b"B"))
+#   batch.transmit()
+class Batch:
+
+    def __init__(self, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL):
+        self.addr = addr
+        self.type = type
+        self.payloads = []
+
+    def add(self, payload):
+        self.payloads.append(payload)
+        return self
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def packet(self):
+        return frame(self.payloads, self.addr, self.type)
+
+    def transmit(self, conn=None):
+        if len(self.payloads) > 0:
+            transmit_batch(self.payloads, self.addr, self.type, conn)
+        self.payloads = []
+
+# TJBChris - Read-back.  The sign answers a read command (READ TEXT, READ STRING, READ SPECIAL) with a packet of its
+# own, sent as the matching write command so it could be replayed to another sign:
+#   NUL... SOH "000" STX <write cmd> <label> <data> ETX <checksum> EOT
+SPECIAL_MEM_CONFIG   = SET_MEM_CONFIG                   # READ SPECIAL - memory configuration
+SPECIAL_TIME         = SET_TIME                         # READ SPECIAL - time of day (HHMM)
+SPECIAL_DATE         = SET_DATE                         # READ SPECIAL - date (MMDDYY)
+SPECIAL_DAY          = SET_DAY                          # READ SPECIAL - day of week (1=Sunday)
+
+# Maps each read command to the write command the sign answers with.
+READ_REPLY_COMMANDS  = {COMMAND_READ_TEXT: COMMAND_WRITE_TEXT, COMMAND_READ_SPECIAL: COMMAND_WRITE_SPECIAL, COMMAND_READ_STRING: COMMAND_WRITE_STRING, COMMAND_READ_DOTS: COMMAND_WRITE_DOTS}
+
+# One entry of the sign's memory configuration.  kind is 'text', 'string' or 'dots'; size is in bytes (for DOTS,
+# rows times columns); extra is the raw four-character tail (run times), or for DOTS the rows and columns (two hex
+# digits each) followed by the color status.
+MemoryEntry = collections.namedtuple('MemoryEntry', ['label', 'kind', 'locked', 'size', 'extra'])
+SignClock = collections.namedtuple('SignClock', ['hour', 'minute', 'month', 'day', 'year', 'weekday'])
+
+MEMORY_KINDS         = {'A': 'text', 'B': 'string', 'D': 'dots'}
+
+# Pulls the command code and data out of a reply packet.  Raises if there's no complete packet or the checksum
+# doesn't match.
+def parse_response(packet):
+    if SOH not in packet:
+        raise Exception("No reply from the sign.")
+    packet = packet[packet.index(SOH):]
+    if STX not in packet or ETX not in packet or EOT not in packet:
+        raise Exception("Incomplete reply from the sign: " + repr(packet))
+
+    stx = packet.index(STX)
+    etx = packet.index(ETX, stx)
+    body = packet[stx+1:etx]
+    sent = packet[etx+1:etx+5]
+    if len(sent) == 4 and sent != checksum(packet[stx:etx+1]):
+        raise Exception("Reply checksum mismatch (got " + sent.decode('latin-1') + ", expected " + checksum(packet[stx:etx+1]).decode('latin-1') + ").")
+    if len(body) == 0:
+        raise Exception("Empty reply from the sign.")
+    return (body[0:1], body[1:])
+
+# Sends one read command and returns the reply's data (everything after the command code).
+def read_request(payload, addr=SIGN_ADDRESS_BROADCAST, conn=None, timeout=READ_TIMEOUT):
+    if conn is None:
+        conn = get_connection()
+    with conn.lock:
+        transmit(payload, addr, conn=conn)
+        (cmd, data) = parse_response(conn.read_packet(timeout))
+
+    expected = READ_REPLY_COMMANDS.get(payload[0:1])
+    if cmd not in (payload[0:1], expected):
+        raise Exception("Unexpected reply to a " + repr(payload[0:1]) + " command: " + repr(cmd + data))
+    return data
+
+# Contents of a TEXT file, exactly as stored (mode and color codes included).
+def read_text(label, addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    return read_request(COMMAND_READ_TEXT + label, addr, conn)[1:]
+
+def read_string(label, addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    return read_request(COMMAND_READ_STRING + label, addr, conn)[1:]
+
+def read_special(code, addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    return read_request(COMMAND_READ_SPECIAL + code, addr, conn)[1:]
+
+# Returns the sign's memory configuration as a list of MemoryEntry, parsed from the same 11-byte entries
+# config_mem() sends: label, type, lock, size (4 hex digits), and a 4-character tail.
+def read_memory_config(addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    return parse_memory_entries(read_special(SPECIAL_MEM_CONFIG, addr, conn))
+
+# Parses memory configuration entries, as read back from the sign or as sent by config_mem() (after the E$).
+def parse_memory_entries(data):
+    entries = []
+    for i in range(0, len(data) - len(data) % 11, 11):
+        entry = data[i:i+11].decode('latin-1')
+        kind = MEMORY_KINDS.get(entry[1])
+        if kind is None:
+            continue
+        if kind == 'dots':
+            entries.append(MemoryEntry(entry[0], kind, entry[2] == 'L', int(entry[3:5], 16) * int(entry[5:7], 16), entry[3:11]))
+        else:
+            entries.append(MemoryEntry(entry[0], kind, entry[2] == 'L', int(entry[3:7], 16), entry[7:11]))
+    return entries
+
+def read_clock(addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    hhmm = read_special(SPECIAL_TIME, addr, conn).decode('latin-1')
+    mmddyy = read_special(SPECIAL_DATE, addr, conn).decode('latin-1')
+    day = read_special(SPECIAL_DAY, addr, conn).decode('latin-1')
+    return SignClock(int(hhmm[0:2]), int(hhmm[2:4]), int(mmddyy[0:2]), int(mmddyy[2:4]), 2000 + int(mmddyy[4:6]), int(day[0:1]))
+
+# TJBChris - Rebuilds the shadow for a sign from what it actually holds, so the next update only sends what's
+# different.  Run after a power blip, a reboot, or anything else that may have changed the sign behind our back.
+def reconcile_shadow(shadow, addr=SIGN_ADDRESS_BROADCAST, conn=None, sign=None):
+    if sign is None:
+        sign = addr
+    shadow.invalidate(sign)
+    layout = read_memory_config(addr, conn)
+    shadow.set_layout(sign, layout)
+    readBack = []
+    for entry in layout:
+        label = bytes(entry.label, 'latin-1')
+        if entry.kind == 'text':
+            readBack.append(COMMAND_WRITE_TEXT + label + read_text(label, addr, conn))
+        elif entry.kind == 'string':
+            readBack.append(COMMAND_WRITE_STRING + label + read_string(label, addr, conn))
+        elif entry.kind == 'dots':
+            readBack.append(COMMAND_WRITE_DOTS + label + read_dots(label, addr, conn))
+    shadow.commit(readBack, sign)
+    return len(readBack)
+
+# TJBChris - asyncio API.  transmit() sleeps between chunks, which would freeze an event loop for the seconds a big
+# TEXT file takes.  AsyncSign does the same paced writes without blocking: each chunk is written from a private
+# single-thread executor (so writes stay in order and the loop never waits on USB) and the pacing delay is an
+# asyncio.sleep().  Frames from concurrent callers are queued one after another on an asyncio.Lock, so they never
+# interleave on the wire.  The connection's own lock is held (by the executor thread) for each whole packet too,
+# so they don't interleave with transmit() or an UpdateScheduler sharing the connection either.
+#
+#   sign = AsyncSign()
+#   await asyncio.gather(sign.text(["[red]", "Hello"], "A"), sign.string(["42"], "1"))
+#
+# If a ShadowStore is given, unchanged TEXT/STRING/sequence writes are skipped just as on the command line.
+class AsyncSign:
+
+    def __init__(self, conn=None, addr=SIGN_ADDRESS_BROADCAST, shadow=None, sign=None):
+        import asyncio
+        import concurrent.futures
+
+        self.asyncio = asyncio
+        self.conn = conn if conn is not None else get_connection()
+        self.addr = addr
+        self.shadow = shadow
+        self.sign = sign if sign is not None else addr
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="betabrite-async")
+        self.lock = None
+
+    # Sends payloads in one packet.  Returns how many were sent (after shadow filtering).
+    async def send(self, payloads, type=SIGN_TYPE_ALL, checksummed=False, force=False):
+        if self.lock is None:
+            self.lock = self.asyncio.Lock()
+
+        async with self.lock:
+            if self.shadow is not None:
+                payloads = self.shadow.filter(payloads, self.sign, force)
+            if len(payloads) == 0:
+                return 0
+
+            packet = list(iter_frame(payloads, self.addr, type, checksummed))
+            # The executor has one thread, so the release always runs on the thread that acquired.  Shielded so
+            # that a cancelled caller still gets the lock before handing it back.
+            acquired = self._run(self.conn.lock.acquire)
+            try:
+                await self.asyncio.shield(acquired)
+                attempt = 0
+                while True:
+                    try:
+                        with METRICS.span('write', sign=self.conn.name):
+                            await self._write_packet(packet)
+                        METRICS.count('packets', sign=self.conn.name)
+                        break
+                    except self.conn.transport.errors:
+                        await self._run(self.conn.close)
+                        if attempt >= self.conn.retries:
+                            METRICS.count('write_failures', sign=self.conn.name)
+                            raise
+                        METRICS.count('write_retries', sign=self.conn.name)
+                        attempt += 1
+            finally:
+                await self._run(self.conn.lock.release)
+            count_commands(payloads, self.conn.name)
+
+            if self.shadow is not None:
+                await self._run(self.shadow.commit, payloads, self.sign)
+            return len(payloads)
+
+    async def _run(self, fn, *args):
+        return await self.asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _write_packet(self, packet):
+        await self._run(self.conn.open)
+        write = self.conn.transport.write
+        delay = self.conn.pacing.delay
+        sent = 0
+        for chunk in iter_chunks(packet, self.conn.pacing.chunkSize):
+            await self._run(write, chunk)
+            sent += len(chunk)
+            if delay:
+                await self.asyncio.sleep(delay)
+        await self._run(self.conn.flush)
+        METRICS.count('bytes_sent', sent, sign=self.conn.name)
+
+    async def text(self, tokens, label='A', force=False):
+        return await self.send([list(iter_write_file(parse_text_message(tokens), bytes(label, 'utf-8')))], force=force)
+
+    async def string(self, values, label, force=False):
+        return await self.send([write_string(values, label)], force=force)
+
+    # Special functions: settime, setdate, setday, setsequence (see parse_function), or cfgmem (see config_mem).
+    async def special(self, funcmode, data, force=False):
+        if funcmode == 'cfgmem':
+            return await self.send([config_mem(funcmode, data)], force=force)
+        return await self.send([parse_function(funcmode, data)], force=force)
+
+    async def raw(self, data, force=False):
+        return await self.send([sendRaw(data)], force=force)
+
+    async def batch(self, payloads, force=False):
+        return await self.send(list(payloads), force=force)
+
+    async def close(self):
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=True)
+
+# TJBChris - Verified sends.  Rather than sending an update twice "just to be sure", we send it once with
+# checksums, then ask the sign whether it was happy.  The sign keeps a serial error status register; each packet
+# starts by clearing it (E4) so the value we read back (F*) covers just that packet.  The register always has bit
+# 6 set; any of the low six bits means something went wrong (see SERIAL_ERROR_BITS).
+#
+# A batch first goes out as one nested packet.  If the sign reports an error we can't tell which command was hit,
+# so each command is then resent on its own and only the ones that fail again are retried, with a doubling delay
+# between rounds (capped at VERIFY_MAX_BACKOFF).
+CLEAR_SERIAL_ERRORS  = b"\x34"     # SPEC_FUNC - Clear Serial Error Status Register (4)
+SPECIAL_SERIAL_ERRORS = b"\x2a"    # READ SPECIAL - Serial Error Status Register (*)
+VERIFY_RETRIES       = 3
+VERIFY_BACKOFF       = 0.1          # Seconds before the first retry
+VERIFY_MAX_BACKOFF   = 2.0
+
+SERIAL_ERROR_BITS = [
+    (0x20, "illegal command or file label"),
+    (0x10, "checksum error"),
+    (0x08, "receive buffer overflow"),
+    (0x04, "serial timeout"),
+    (0x02, "bit framing error"),
+    (0x01, "parity error"),
+]
+
+# Reads the serial error status register.  Returns a list of problems (empty if none).
+def read_serial_errors(addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    data = read_special(SPECIAL_SERIAL_ERRORS, addr, conn)
+    if len(data) >= 2:
+        status = int(data[0:2], 16)
+    elif len(data) == 1:
+        status = data[0]
+    else:
+        raise Exception("Empty serial error status from the sign.")
+    return [problem for (bit, problem) in SERIAL_ERROR_BITS if status & bit]
+
+# The commands a checked send puts in its packet: the payloads, after clearing the serial error register.
+def checked_payloads(payloads):
+    return [COMMAND_WRITE_SPECIAL + CLEAR_SERIAL_ERRORS] + list(payloads)
+
+# Sends the payloads once, checksummed, and returns the sign's complaints (empty list if it took them).
+def transmit_checked(payloads, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, conn=None):
+    if conn is None:
+        conn = get_connection()
+    with conn.lock:
+        transmit_batch(checked_payloads(payloads), addr, type, conn, checksummed=True)
+        return read_serial_errors(addr, conn)
+
+# Sends payloads so that each is confirmed by the sign, retrying only the ones that fail.  Returns the number of
+# retries it took; raises if any payload still fails after retries.
+def transmit_verified(payloads, addr=SIGN_ADDRESS_BROADCAST, type=SIGN_TYPE_ALL, conn=None, retries=VERIFY_RETRIES, backoff=VERIFY_BACKOFF):
+    if conn is None:
+        conn = get_connection()
+
+    problems = transmit_checked(payloads, addr, type, conn)
+    if len(problems) == 0:
+        return 0
+
+    pending = list(payloads)
+    retried = 0
+    delay = backoff
+    for attempt in range(retries):
+        time.sleep(delay)
+        delay = min(delay * 2, VERIFY_MAX_BACKOFF)
+
+        failed = []
+        for payload in pending:
+            retried += 1
+            METRICS.count('verify_retries', sign=conn.name, command=payload_kind(payload)[0], label=payload_kind(payload)[1])
+            problems = transmit_checked([payload], addr, type, conn)
+            if len(problems) > 0:
+                failed.append(payload)
+        if len(failed) == 0:
+            return retried
+        pending = failed
+
+    METRICS.count('verify_failures', len(pending), sign=conn.name)
+    raise Exception("%d of %d command(s) still failed after %d retries.  The sign reported: %s" % (len(pending), len(payloads), retries, ", ".join(problems)))
+
+# TJBChris - Shadow of what the sign is showing.  The sign blanks on every TEXT write and every byte costs wire
+# time, so we remember a hash of the last TEXT, STRING and run sequence payload sent to each sign address and
+# skip writes that wouldn't change anything.  Clearing or reconfiguring memory (E$) wipes the sign, so it wipes
+# the shadow for that address too.  The shadow can't see changes made by other tools or a sign that lost its
+# memory; use --force (or force=True) to send regardless.
+#
+# Entries are kept per sign: by its registered name for named signs (see SignTarget), otherwise by its port and
+# address (see port_sign).
+SHADOW_FILE          = 'shadow.json'
+
+# Returns the shadow key for a payload, or None if the payload isn't tracked.
+def shadow_key(payload):
+    head = payload_head(payload, 2)
+    cmd = head[0:1]
+    if cmd == COMMAND_WRITE_TEXT and len(head) >= 2:
+        return 'text:' + head[1:2].decode('latin-1')
+    if cmd == COMMAND_WRITE_STRING and len(head) >= 2:
+        return 'string:' + head[1:2].decode('latin-1')
+    if cmd == COMMAND_WRITE_DOTS and len(head) >= 2:
+        return 'dots:' + head[1:2].decode('latin-1')
+    if head == COMMAND_WRITE_SPECIAL + SET_SEQUENCE:
+        return 'sequence'
+    # Resending a counter's settings would restart it.
+    if head == COMMAND_WRITE_SPECIAL + SET_COUNTER:
+        return 'counter:' + payload_head(payload, 3)[2:3].decode('latin-1')
+    return None
+
+# True for payloads that wipe every TEXT and STRING file on the sign (clear and cfgmem).
+def shadow_invalidates(payload):
+    return payload_head(payload, 2) == COMMAND_WRITE_SPECIAL + SET_MEM_CONFIG
+
+# The shadow store key for a sign: a sign name, or a sign address (bytes).
+def shadow_sign(sign):
+    return sign.decode('latin-1') if isinstance(sign, bytes) else sign
+
+# The name an unregistered sign (--port and --address) goes by in the shadow store and the scheduler: its
+# transport spec plus its address, so that sending to one port (a file: capture, say) doesn't make a sign on
+# another look up to date.
+def port_sign(conn, addr):
+    return (conn.name if conn is not None else DEFAULT_PORT) + ':' + addr.decode('latin-1')
+
+class ShadowStore:
+
+    def __init__(self, name=SHADOW_FILE):
+        self.name = name
+        self.signs = load_state(name, {})
+        # Fan-out sends commit from several threads at once.
+        self.lock = threading.Lock()
+
+    def get(self, sign, key):
+        return self.signs.get(shadow_sign(sign), {}).get(key)
+
+    # The sign's memory layout as a list of MemoryEntry, if known (from the last cfgmem sent, or a read-back).
+    def get_layout(self, sign):
+        layout = self.signs.get(shadow_sign(sign), {}).get('memory')
+        if layout is None:
+            return None
+        return [MemoryEntry(*entry) for entry in layout]
+
+    def set_layout(self, sign, layout):
+        with self.lock:
+            self.signs.setdefault(shadow_sign(sign), {})['memory'] = [list(entry) for entry in layout]
+
+    def invalidate(self, sign, key=None):
+        with self.lock:
+            entries = self.signs.get(shadow_sign(sign), {})
+            if key is None:
+                entries.clear()
+            else:
+                entries.pop(key, None)
+
+    # Drops payloads whose content the sign already has.  Order is kept, and anything after a clear or cfgmem
+    # in the same list is always sent.
+    def filter(self, payloads, sign=SIGN_ADDRESS_BROADCAST, force=False):
+        if force:
+            return list(payloads)
+
+        wiped = False
+        pending = []
+        for payload in payloads:
+            if shadow_invalidates(payload):
+                wiped = True
+            key = shadow_key(payload)
+            if key is not None and not wiped and self.get(sign, key) == payload_digest(payload):
+                continue
+            pending.append(payload)
+        return pending
+
+    # Records payloads that were sent successfully, in order, and saves the store.
+    def commit(self, payloads, sign=SIGN_ADDRESS_BROADCAST):
+        with self.lock:
+            entries = self.signs.setdefault(shadow_sign(sign), {})
+            for payload in payloads:
+                if shadow_invalidates(payload):
+                    entries.clear()
+                    entries['memory'] = [list(entry) for entry in parse_memory_entries(b''.join(payload_pieces(payload))[2:])]
+                key = shadow_key(payload)
+                if key is not None:
+                    entries[key] = payload_digest(payload)
+            save_state(self.name, self.signs)
+
+    def save(self):
+        with self.lock:
+            save_state(self.name, self.signs)
+
+# TJBChris - Update scheduler.  Bursty producers often rewrite the same label several times a second, and every
+# intermediate version would otherwise be sent in full (blanking the sign each time).  The scheduler sits in front
+# of transmit() and keeps only the newest pending payload per (sign, label); a replaced payload keeps its place in
+# line.  Label 0 (FILE_PRIORITY) goes ahead of everything else.  Each sign has its own worker thread and,
+# optionally, a byte-rate budget (token bucket, one second of burst) so one chatty producer can't saturate it.
+#
+# An urgent payload doesn't wait behind a long upload already on the wire: the upload is preempted at the next
+# safe point (see SignConnection.write), the urgent payload goes out, and the interrupted one is queued again in
+# its old place (unless a newer version of it has been submitted meanwhile).  So an alert's time to display is
+# bounded by its own size.  Verified sends (verify=True) are never preempted.
+#
+# A memory configuration (clear or cfgmem) is a barrier: it wipes the sign, so nothing queued after it, label 0
+# included, goes out before it, and it is never preempted.
+#
+#   scheduler = UpdateScheduler(byteRate=500)
+#   scheduler.submit(write_string(["42"], "1"))
+#   ...
+#   scheduler.stop()
+PRIORITY_URGENT      = 0
+PRIORITY_NORMAL      = 1
+
+# Default priority for a payload: urgent for the priority TEXT label, normal for everything else.
+def payload_priority(payload):
+    if payload_head(payload, 2) == COMMAND_WRITE_TEXT + FILE_PRIORITY:
+        return PRIORITY_URGENT
+    return PRIORITY_NORMAL
+
+# What a pending payload is coalesced by: its shadow key (TEXT/STRING label, sequence) if it has one, otherwise the
+# command and special function code (so repeated settime, say, also collapse).  Memory config is never coalesced.
+def coalesce_key(payload):
+    key = shadow_key(payload)
+    if key is not None:
+        return key
+    if shadow_invalidates(payload):
+        return None
+    return 'cmd:' + payload_head(payload, 2).decode('latin-1')
+
+class _PendingUpdate:
+
+    def __init__(self, payload, priority, seq, force=False):
+        self.payload = payload
+        self.priority = priority
+        self.seq = seq
+        self.force = force
+
+class _SignQueue:
+
+    def __init__(self, conn, addr, sign, byteRate):
+        self.conn = conn
+        self.addr = addr
+        self.sign = sign
+        self.byteRate = byteRate
+        self.tokens = float(byteRate) if byteRate else 0.0
+        self.refilled = time.monotonic()
+        self.heap = []
+        self.pending = {}
+        self.barrier = -1
+        self.inflight = None
+        self.thread = None
+
+    # Blocks until the budget allows sending size bytes, then spends them.  A packet larger than the burst is let
+    # through once the bucket is full, leaving it in debt.
+    def spend(self, size, stopped):
+        if not self.byteRate:
+            return
+        while not stopped.is_set():
+            now = time.monotonic()
+            self.tokens = min(float(self.byteRate), self.tokens + (now - self.refilled) * self.byteRate)
+            self.refilled = now
+            needed = min(size, self.byteRate)
+            if self.tokens >= needed:
+                self.tokens -= size
+                return
+            stopped.wait((needed - self.tokens) / self.byteRate)
+
+class UpdateScheduler:
+
+    def __init__(self, shadow=None, byteRate=None, verify=False, retries=VERIFY_RETRIES):
+        self.shadow = shadow if shadow is not None else ShadowStore()
+        self.byteRate = byteRate
+        self.verify = verify
+        self.retries = retries
+        self.seq = itertools.count()
+        self.queues = {}
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.errors = []
+
+    # Queues a payload for a sign (default connection and broadcast address unless given).  sign names the sign
+    # for coalescing and the shadow; it defaults to the address.  force sends it even if the shadow says the sign
+    # already has it.
+    def submit(self, payload, conn=None, addr=SIGN_ADDRESS_BROADCAST, sign=None, priority=None, force=False):
+        if conn is None:
+            conn = get_connection()
+        if sign is None:
+            sign = addr
+        if priority is None:
+            priority = payload_priority(payload)
+
+        with self.cond:
+            queue = self.queues.get(shadow_sign(sign))
+            if queue is None:
+                queue = _SignQueue(conn, addr, sign, self.byteRate)
+                self.queues[shadow_sign(sign)] = queue
+                queue.thread = threading.Thread(target=self._worker, args=(queue,), name="betabrite-scheduler-" + shadow_sign(sign), daemon=True)
+                queue.thread.start()
+
+            seq = next(self.seq)
+            # Nothing jumps a pending memory configuration, or it would be wiped as soon as it landed.
+            barrier = queue.pending.get('seq:%d' % queue.barrier)
+            if barrier is not None and priority < barrier.priority:
+                priority = barrier.priority
+            key = coalesce_key(payload)
+            if key is None:
+                key = 'seq:%d' % seq
+                queue.barrier = seq
+
+            update = queue.pending.get(key)
+            # Replace a pending payload in place, unless a memory reconfiguration has been queued since (the new
+            # payload has to go after it) or the new one is more urgent.
+            if update is not None and update.seq > queue.barrier and priority >= update.priority:
+                update.payload = payload
+                update.force = force
+            else:
+                update = _PendingUpdate(payload, priority, seq, force)
+                queue.pending[key] = update
+                heapq.heappush(queue.heap, (priority, seq, key))
+
+            # Cut short a less urgent upload that's on the wire right now.
+            if queue.inflight is not None and priority < queue.inflight.priority and not self.verify:
+                queue.conn.preempt.set()
+            self.cond.notify_all()
+
+    def _next(self, queue):
+        with self.cond:
+            while not self.stopped.is_set():
+                while queue.heap:
+                    (priority, seq, key) = heapq.heappop(queue.heap)
+                    update = queue.pending.get(key)
+                    # Skip heap entries left behind when a payload was re-queued under a new position.
+                    if update is not None and update.seq == seq:
+                        del queue.pending[key]
+                        # A preempt meant for an upload that finished anyway must not hit this one.
+                        queue.conn.preempt.clear()
+                        queue.inflight = update
+                        return (key, update)
+                self.cond.wait()
+            return (None, None)
+
+    def _worker(self, queue):
+        while True:
+            (key, update) = self._next(queue)
+            if update is None:
+                return
+            try:
+                payloads = self.shadow.filter([update.payload], queue.sign, update.force)
+                if len(payloads) > 0:
+                    queue.spend(frame_len(payloads), self.stopped)
+                    if self.verify:
+                        transmit_verified(payloads, queue.addr, conn=queue.conn, retries=self.retries)
+                    else:
+                        transmit_batch(payloads, queue.addr, conn=queue.conn, preemptible=update.priority > PRIORITY_URGENT and not shadow_invalidates(update.payload))
+                    self.shadow.commit(payloads, queue.sign)
+            except Preempted:
+                # The sign now holds a truncated copy, if anything.  Put the payload back where it was, unless
+                # it's been superseded while it was on the wire.  Only a cut-short memory configuration leaves the
+                # whole sign in doubt; payloads the shadow doesn't track (settime, raw commands) change nothing.
+                if shadow_invalidates(update.payload):
+                    self.shadow.invalidate(queue.sign)
+                elif shadow_key(update.payload) is not None:
+                    self.shadow.invalidate(queue.sign, shadow_key(update.payload))
+                with self.cond:
+                    if key not in queue.pending:
+                        queue.pending[key] = update
+                        heapq.heappush(queue.heap, (update.priority, update.seq, key))
+            except Exception as e:
+                with self.cond:
+                    self.errors.append((shadow_sign(queue.sign), key, e))
+            with self.cond:
+                queue.inflight = None
+                self.cond.notify_all()
+
+    # Number of payloads waiting (for one sign, or all).
+    def pending(self, sign=None):
+        with self.cond:
+            if sign is not None:
+                queue = self.queues.get(shadow_sign(sign))
+                return 0 if queue is None else len(queue.pending)
+            return sum(len(q.pending) for q in self.queues.values())
+
+    # Waits until every queue is empty (or timeout seconds pass).  Returns True if everything was sent.
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while any(q.pending or q.inflight is not None for q in self.queues.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def stop(self, flush=True, timeout=None):
+        if flush:
+            self.flush(timeout)
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        for queue in list(self.queues.values()):
+            queue.thread.join(timeout)
+
+# TJBChris - Memory layout planner.  Configuring memory (cfgmem) wipes every label, so layouts tend to be
+# hand-written with lots of slack, and outgrowing one means re-sending everything by hand.  plan_memory() sizes each
+# TEXT and STRING allocation from the payloads that will actually go there, plus headroom so small edits still fit,
+# and checks the total against the sign's memory.  auto_memory() leaves the current layout alone as long as every
+# payload still fits; when one doesn't, it returns a single migration batch: the new layout, then every label,
+# string and the run sequence, so the sign is rebuilt in one packet.
+SIGN_MEMORY_TOTAL    = int(os.environ.get('BETABRITE_MEMORY', '32768'))    # bytes of TEXT/STRING memory; depends on the model
+MEMORY_HEADROOM      = 0.25         # fraction added on top of what each payload needs
+MEMORY_GRANULE       = 16           # allocations are rounded up to this
+MEMORY_MIN_TEXT      = 32           # smallest TEXT allocation
+MEMORY_MIN_STRING    = 16           # smallest STRING allocation (a template's fields start out empty)
+STRING_MAX           = 125
+TEXT_MAX             = 65535
+
+# Bytes each TEXT and STRING label needs for these payloads, as {(kind, label): size}.  DOTS pictures need an
+# allocation of exactly their size, so for them it's (rows, columns) instead.  Label 0 needs no memory
+# configuration, and other commands don't occupy memory.
+def memory_needs(payloads):
+    needs = {}
+    for payload in payloads:
+        head = payload_head(payload, 2)
+        if len(head) < 2 or head[1:2] == FILE_PRIORITY:
+            continue
+        if head[0:1] == COMMAND_WRITE_TEXT:
+            needs[('text', head[1:2].decode('latin-1'))] = payload_len(payload) - 2
+        elif head[0:1] == COMMAND_WRITE_STRING:
+            needs[('string', head[1:2].decode('latin-1'))] = payload_len(payload) - 2
+        elif head[0:1] == COMMAND_WRITE_DOTS:
+            shape = payload_head(payload, 6)[2:6]
+            needs[('dots', head[1:2].decode('latin-1'))] = (int(shape[0:2], 16), int(shape[2:4], 16))
+    return needs
+
+def plan_memory(payloads, headroom=MEMORY_HEADROOM, capacity=SIGN_MEMORY_TOTAL):
+    layout = []
+    for ((kind, label), need) in sorted(memory_needs(payloads).items()):
+        if kind == 'dots':
+            layout.append(MemoryEntry(label, kind, True, need[0] * need[1], "%0.2X%0.2X" % need + DOTS_COLOR_STATUS))
+            continue
+        size = -(-int(need * (1 + headroom)) // MEMORY_GRANULE) * MEMORY_GRANULE
+        if kind == 'string':
+            if need > STRING_MAX:
+                raise Exception("String " + label + " needs %d bytes; strings cannot be larger than %d bytes." % (need, STRING_MAX))
+            size = min(max(size, MEMORY_MIN_STRING), STRING_MAX)
+        else:
+            if need > TEXT_MAX:
+                raise Exception("Text " + label + " needs %d bytes; text labels cannot be larger than %d bytes." % (need, TEXT_MAX))
+            size = min(max(size, MEMORY_MIN_TEXT), TEXT_MAX)
+        layout.append(MemoryEntry(label, kind, kind == 'string', size, '0000' if kind == 'string' else '00FF'))
+
+    total = sum(entry.size for entry in layout)
+    if total > capacity:
+        raise Exception("The planned layout needs %d bytes but the sign has %d.  Shorten some messages or reduce the headroom." % (total, capacity))
+    return layout
+
+# The cfgmem specs (as taken by config_mem) for a layout.
+def memory_specs(layout):
+    specs = []
+    for entry in layout:
+        if entry.kind == 'dots':
+            specs.append("d[%s,%dx%d]" % (entry.label, int(entry.extra[0:2], 16), int(entry.extra[2:4], 16)))
+        else:
+            specs.append(("t" if entry.kind == 'text' else "s") + "[%s,%d]" % (entry.label, entry.size))
+    return specs
+
+# True if every TEXT, STRING and DOTS payload fits the layout as it is.
+def layout_fits(layout, payloads):
+    entries = dict(((entry.kind, entry.label), entry) for entry in layout)
+    for (key, need) in memory_needs(payloads).items():
+        entry = entries.get(key)
+        if entry is None:
+            return False
+        if key[0] == 'dots':
+            if entry.extra[0:4] != "%0.2X%0.2X" % need:
+                return False
+        elif entry.size < need:
+            return False
+    return True
+
+# Returns the payloads to send so that they fit the sign: unchanged if the known layout already fits them,
+# otherwise a migration batch.  payloads must describe the whole sign (every label, string and the run sequence),
+# because the new layout erases anything not in it.
+def auto_memory(payloads, layout=None, headroom=MEMORY_HEADROOM, capacity=SIGN_MEMORY_TOTAL):
+    payloads = [p for p in payloads if not shadow_invalidates(p)]
+    if layout is not None and layout_fits(layout, payloads):
+        return payloads
+
+    plan = plan_memory(payloads, headroom, capacity)
+    (strings, texts, others) = ([], [], [])
+    for payload in payloads:
+        cmd = payload_head(payload, 1)
+        if cmd in (COMMAND_WRITE_STRING, COMMAND_WRITE_DOTS):
+            strings.append(payload)
+        elif cmd == COMMAND_WRITE_TEXT:
+            texts.append(payload)
+        else:
+            others.append(payload)
+    # Strings and pictures before texts (texts may insert them), and the run sequence and other specials last.
+    return [config_mem('cfgmem', memory_specs(plan))] + strings + texts + others
+
+# TJBChris - Pacing calibration.  SIGN_TYPE_ALL_VERIFY makes the sign show "TRANSMISSION OK" or
+# "TRANSMISSION ERROR" after each packet.  We send a long priority message at increasingly aggressive pacing and
+# ask confirm(profile) (by default, the person watching the sign) whether it got through.  For each chunk size
+# we walk the delays from slowest to fastest and stop at the first failure; once a chunk size fails even at
+# the slowest delay, larger ones will too.  The profile with the lowest estimated cost (delays plus writes) wins.
+def calibrate_pacing(conn, confirm=None, chunkSizes=PACING_CHUNK_SIZES, delays=PACING_DELAYS, save=True):
+
+    if confirm is None:
+        def confirm(profile):
+            answer = input("Sent with %r.  Did the sign show TRANSMISSION OK? [y/N] " % profile)
+            return answer.strip().lower().startswith('y')
+
+    testPayload = write_file([animation("CALIBRATING " + "0123456789" * 20, MODE_HOLD, TEXT_COLOR_GREEN)])
+    testSize = len(WAKEUP + SOH + SIGN_TYPE_ALL_VERIFY + SIGN_ADDRESS_BROADCAST + STX + testPayload + EOT)
+    savedPacing = conn.pacing
+    best = None
+
+    try:
+        for chunkSize in sorted(chunkSizes):
+            chunkOk = False
+            for delay in sorted(delays, reverse=True):
+                profile = PacingProfile(chunkSize, delay)
+                conn.pacing = profile
+                transmit(testPayload, type=SIGN_TYPE_ALL_VERIFY, conn=conn)
+                if not confirm(profile):
+                    break
+                chunkOk = True
+                if best is None or profile.cost(testSize) < best.cost(testSize):
+                    best = profile
+            if not chunkOk:
+                break
+    finally:
+        conn.pacing = savedPacing
+        # Release the priority label used for the test message.
+        transmit(write_file([]), conn=conn)
+
+    if best is None:
+        raise Exception("No pacing profile was accepted by the sign; keeping the current profile.")
+
+    conn.pacing = best
+    if save:
+        best.save()
+    return best
 
 # File priority = label
 def write_file(animations, file=FILE_PRIORITY):
-    payload = COMMAND_WRITE_TEXT + file
-    for animation in animations:
-        payload += animation
-    return payload
+    return b''.join(iter_write_file(animations, file))
+
+# Same as write_file(), but yields the command header and then each animation as its own piece.
+def iter_write_file(animations, file=FILE_PRIORITY):
+    yield COMMAND_WRITE_TEXT + file
+    yield from animations
+
+# TJBChris - Streams a large, already sign-ready TEXT file from disk.  The file is memory-mapped and handed to the
+# writer as a memoryview, so even a 64K label is never read into (or copied around) memory as a whole.  The
+# file's bytes are sent as-is: no tags, no transcoding.  Returns the payload as a list of pieces (a MappedText,
+# unless the file is empty); close_payloads() unmaps it once it's been sent.
+def stream_text_file(path, file=FILE_PRIORITY, mode=MODE_AUTO, color=TEXT_COLOR_AUTO, position=TEXT_POS_MIDDLE):
+    header = COMMAND_WRITE_TEXT + file + SOM + position + mode + color
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [header]
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedText(header, mm)
+
+# A payload whose body is a memory-mapped file: the header and a memoryview of the map, like any other list of
+# pieces, plus close() to unmap it.
+class MappedText(list):
+
+    def __init__(self, header, mm):
+        list.__init__(self, [header, memoryview(mm)])
+        self.mm = mm
+
+    def close(self):
+        for piece in self:
+            if isinstance(piece, memoryview):
+                piece.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # Something (a traceback, say) still holds a slice of it; it's unmapped when that goes away.
+            pass
+
+# Unmaps the memory-mapped payloads in a list (see MappedText) once they've been sent or copied.
+def close_payloads(payloads):
+    for payload in payloads:
+        if isinstance(payload, MappedText):
+            payload.close()
 
 def animation(msg, mode=MODE_AUTO, color=TEXT_COLOR_AUTO, position=TEXT_POS_MIDDLE):
     return SOM + position + mode + color + transcode(msg)    
@@ -474,19 +2012,112 @@ def animation(msg, mode=MODE_AUTO, color=TEXT_COLOR_AUTO, position=TEXT_POS_MIDD
 def soft_reset():
     return COMMAND_WRITE_SPECIAL + b"\x2c"
 
-def transcode(msg):
-    b = bytes(msg, 'utf-8')
-    b = b.replace(b'\xc2\xb0', DEGREES)
-    return b
-
-# TJBChris - Configure STRING and TEXT memory areas.
+# TJBChris - Character translation.  The sign doesn't understand UTF-8; its accented letters and symbols are the
+# single bytes 0x80-0xC1 (or, equivalently, 0x08 followed by 0x20-0x61, the XC_ codes).  transcode() turns text
+# into sign bytes in one str.translate() pass over a table built once per policy, so it stays linear however
+# long the message is.  ASCII passes straight through.
+#
+# Characters the sign has no glyph for are handled by a policy, BETABRITE_UNMAPPED in the environment:
+#   fold      (default) the nearest plain letters or punctuation: o for o-double-acute, " for curly quotes,
+#             EUR for the euro sign; ? if there's nothing close
+#   replace   ?
+#   ignore    dropped
+#   strict    raise an exception naming the character
+# Set BETABRITE_CHARSET=extended to send the 0x08 codes instead of the single bytes, for links that mangle
+# bytes with the high bit set.
+TRANSCODE_POLICY     = os.environ.get('BETABRITE_UNMAPPED', 'fold')
+TRANSCODE_EXTENDED   = os.environ.get('BETABRITE_CHARSET', 'single') == 'extended'
+TRANSCODE_POLICIES   = ('fold', 'replace', 'ignore', 'strict')
+
+# Unicode character -> sign byte.  Some constants above share a name (e_GRAVE, a_ACCENT, E_ACCENT), so the
+# bytes that lost their name are written out.
+SIGN_CHARACTERS = [
+    ('Ç', C_TAIL), ('ü', u_UMLAUT), ('é', b"\x82"), ('â', a_CIRCUMFLEX), ('ä', a_UMLAUT), ('à', b"\x85"),
+    ('å', a_CIRCLE), ('ç', c_TAIL), ('ê', e_CIRCUMFLEX), ('ë', e_UMLAUT), ('è', e_GRAVE), ('ï', i_UMLAUT),
+    ('î', i_CIRCUMFLEX), ('ì', i_GRAVE), ('Ä', A_UMLAUT), ('Å', A_CIRCLE), ('É', b"\x90"), ('æ', ae_LIGATURE),
+    ('Æ', AE_LIGATURE), ('ô', o_CIRCUMFLEX), ('ö', o_UMLAUT), ('ò', o_GRAVE), ('û', u_CIRCUMFLEX), ('ù', u_GRAVE),
+    ('ÿ', y_UMLAUT), ('Ö', O_UMLAUT), ('Ü', U_UMLAUT), ('¢', CENTS), ('£', POUNDS), ('¥', YEN), ('ƒ', SLANT_F),
+    ('á', a_ACCENT), ('í', i_ACCENT), ('ó', o_ACCENT), ('ú', u_ACCENT), ('ñ', n_TILDE), ('Ñ', N_TILDE),
+    ('ª', SUPER_a), ('º', SUPER_o), ('¿', INVERT_QUESTION), ('°', DEGREES), ('¡', INVERT_EXCLAIM),
+    ('\u200a', SINGLE_COL_SPACE), ('θ', theta), ('Θ', THETA), ('ć', c_ACCENT), ('Ć', C_ACCENT), ('č', CHAR_c),
+    ('Č', CHAR_C), ('đ', CHAR_d), ('Đ', CHAR_D), ('š', CHAR_s), ('ž', CHAR_z), ('Ž', CHAR_Z), ('ß', BETA),
+    ('Š', CHAR_S), ('β', BETA2), ('Á', A_ACCENT), ('À', A_GRAVE), ('Ã', A_2ACCENT), ('ã', a_2ACCENT),
+    ('Í', I_ACCENT), ('Õ', O_TILDE), ('õ', o_TILDE),
+]
+
+# Fold policy: punctuation and symbols with a close ASCII spelling that decomposition doesn't find.
+TRANSCODE_FOLDS = {
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u201c': '"', '\u201d': '"', '\u201e': '"', '\u2013': '-',
+    '\u2014': '-', '\u2212': '-', '\u2026': '...', '\u2022': '*', '\u00b7': '*', '\u00d7': 'x', '\u00f7': '/',
+    '\u20ac': 'EUR', '\u00a9': '(C)', '\u00ae': '(R)', '\u2122': 'TM', '\u00a7': 'S', '\u00b1': '+/-',
+    '\u00f8': 'o', '\u00d8': 'O', '\u0142': 'l', '\u0141': 'L', '\u00f0': 'd', '\u00de': 'Th', '\u00fe': 'th',
+}
+
+# A translation table for str.translate().  It starts with ASCII and the sign's own characters; anything else is
+# worked out (by the policy) the first time it's seen, then kept, so each distinct character costs one lookup.
+class TranscodeTable(dict):
+
+    def __init__(self, policy=TRANSCODE_POLICY, extended=TRANSCODE_EXTENDED):
+        dict.__init__(self)
+        if policy not in TRANSCODE_POLICIES:
+            raise Exception("Unknown policy for characters the sign can't show: " + policy + ".  Use one of " + ", ".join(TRANSCODE_POLICIES) + ".")
+        self.policy = policy
+        for c in range(0x80):
+            self[c] = chr(c)
+        for (c, code) in SIGN_CHARACTERS:
+            self[ord(c)] = (b"\x08" + bytes([code[0] - 0x60]) if extended else code).decode('latin-1')
+
+    def __missing__(self, c):
+        if self.policy == 'strict':
+            raise Exception("The sign has no character for %r (U+%04X)." % (chr(c), c))
+        if self.policy == 'ignore':
+            value = ''
+        elif self.policy == 'fold':
+            value = self.fold(chr(c))
+        else:
+            value = '?'
+        self[c] = value
+        return value
+
+    # Nearest spelling the sign can show: a listed fold, or the character with its accents removed (which may
+    # itself be a sign character, as for an o with a double acute).
+    def fold(self, c):
+        import unicodedata
+        if c in TRANSCODE_FOLDS:
+            return TRANSCODE_FOLDS[c]
+        if unicodedata.combining(c):
+            return ''
+        base = ''.join(ch for ch in unicodedata.normalize('NFKD', c) if not unicodedata.combining(ch))
+        if base and base != c and all(ord(ch) in self for ch in base):
+            return ''.join(self[ord(ch)] for ch in base)
+        return '?'
+
+_transcode_tables = {}
+
+def transcode_table(policy=TRANSCODE_POLICY, extended=TRANSCODE_EXTENDED):
+    key = (policy, extended)
+    if key not in _transcode_tables:
+        _transcode_tables[key] = TranscodeTable(policy, extended)
+    return _transcode_tables[key]
+
+TRANSCODE_TABLE = transcode_table()
+
+def transcode(msg, policy=TRANSCODE_POLICY, extended=TRANSCODE_EXTENDED):
+    if msg.isascii():
+        return msg.encode('ascii')
+    import unicodedata
+    # Composed first, so an e followed by a combining accent becomes the sign's e-acute.
+    return unicodedata.normalize('NFC', msg).translate(transcode_table(policy, extended)).encode('latin-1')
+
+# TJBChris - Configure STRING, TEXT and DOTS memory areas.
 def config_mem(funcmode, reqdata):
 
     # The file configs are as follows:
     # type[label,size_in_bytes], for example s[A,100] for a 100-byte string reservation labeled A, or
     # t[c,255] for a 255-byte text reservation labeled c.  ** CASE MATTERS IN LABEL NAMES AND TYPE CODES! **
     # We cannot have values larger than 64K (FFFF).  Additionally, Label 0 is special, so it can't be configured here at all.
-    defFormat = r"^[st]\[[a-zA-Z0-9],[0-9]{1,4}\]$"
+    # DOTS pictures are sized in rows and columns instead: d[P,7x80] is a 7-row, 80-column picture labeled P.
+    defFormat = r"^([st]\[[a-zA-Z0-9],[0-9]{1,5}\]|d\[[a-zA-Z0-9],[0-9]{1,3}x[0-9]{1,3}\])$"
     cfgBytes = None
     timeBytes = None
 
@@ -495,11 +2126,21 @@ def config_mem(funcmode, reqdata):
     for d in reqdata:
 
         if not re.match(defFormat, d):
-            raise Exception("Message definition must be in the form type[label,size_in_bytes], such as s[A,125].  Type is 's' for string or 't' for text.  Got: " + d)
+            raise Exception("Message definition must be in the form type[label,size_in_bytes], such as s[A,125].  Type is 's' for string or 't' for text.  DOTS pictures are d[label,rowsxcolumns], such as d[P,7x80].  Got: " + d)
 
         mtype = d[0]
         label = d[2]
 
+        # DOTS Mode: size is rows and columns (two hex digits each), and the tail is the color status.
+        if mtype == "d":
+            (rows, cols) = [int(n) for n in d[4:len(d)-1].split('x')]
+            if rows < 1 or cols < 1 or rows > DOTS_MAX_HEIGHT or cols > DOTS_MAX_WIDTH:
+                raise Exception("DOTS pictures can be up to %d rows by %d columns.  Got: %s" % (DOTS_MAX_HEIGHT, DOTS_MAX_WIDTH, d))
+            if label == "0":
+                raise Exception ("File 0 cannot be configured.  See BetaBrite Alpha Communication Protocol doc for detail.")
+            retBytes += bytes(label,'utf-8') + b"DL" + bytes("%0.2X%0.2X" % (rows, cols),'utf-8') + bytes(DOTS_COLOR_STATUS,'utf-8')
+            continue
+
         # String Mode
         if mtype == "s":
             # Strings: Must be LOCKED, run times 0000, labels "0" and "?"" are not available. 
@@ -524,6 +2165,8 @@ def config_mem(funcmode, reqdata):
             raise Exception ("File 0 cannot be configured; Strings cannot use 0 or ?.  See BetaBrite Alpha Communication Protocol doc for detail.")
         
         msgSizeBytes = int(d[4:len(d)-1])
+        if msgSizeBytes > 65535:
+            raise Exception ("Text values cannot be larger than 64K (65535 bytes).  See BetaBrite Alpha Communication Protocol doc for detail.")
         # Strings can't be more than 125 bytes.
         if mtype == "s" and msgSizeBytes > 125:
             raise Exception ("String values cannot be larger than 125 bytes.  See BetaBrite Alpha Communication Protocol doc for detail.")
@@ -580,179 +2223,833 @@ def parse_function(funcmode, reqdata):
 
     else:  
         raise Exception("Invalid 'set' mode specified.  Got: " + funcmode)
+
+# TJBChris - Clock sync.  The sign keeps time to the minute and starts the minute over when it's set, so --sync
+# sets time, date and day of week together in one packet, timed to finish landing exactly on a minute boundary
+# and carrying that minute's value.  Time, date and day all come from the same instant, so a sync just before
+# midnight can't leave the sign with today's time and yesterday's date.
+#
+# How long the packet takes to land is learned from earlier syncs (kept per sign in clock.json); before the
+# first one it's the connection's recent write speed from the metrics, or failing that the pacing estimate.
+# With --sync-threshold, the sign is only synced once its estimated error (how far off the last sync landed,
+# plus --drift-rate for every day since) is more than that many seconds, so a cron job can run --sync often.
+CLOCK_FILE           = 'clock.json'
+CLOCK_DRIFT          = 2.0          # Seconds a day the sign's clock is assumed to wander (a typical crystal)
+CLOCK_LATENCY_WEIGHT = 0.3          # Weight of the newest measurement in the running average of landing time
+
+# Time, date and day of week for a moment, in parse_function's formats.  Alpha days run 1 (Sunday) to 7;
+# tm_wday is 0 for Monday.
+def clock_fields(when=None):
+    t = time.localtime(when)
+    return {'time': time.strftime('%H:%M', t), 'date': time.strftime('%m/%d/%y', t), 'day': str((t.tm_wday + 1) % 7 + 1)}
+
+def clock_payloads(when=None):
+    fields = clock_fields(when)
+    return [parse_function('set' + key, [fields[key]]) for key in ('time', 'date', 'day')]
+
+# Seconds a packet of n bytes should take to reach the sign over conn (see above).
+def sync_latency(conn, n, record=None):
+    if record is not None and 'latency' in record:
+        return record['latency']
+    writes = METRICS.timer('write', sign=conn.name)
+    sent = METRICS.counter('bytes_sent', sign=conn.name)
+    if writes is not None and sent > 0:
+        return n * writes[1] / sent
+    return conn.pacing.estimate(n)
+
+# How far off the sign's clock is likely to be by now, in seconds, or None if it was never synced.
+def estimated_drift(record, now, drift=CLOCK_DRIFT):
+    if record is None or 'synced' not in record:
+        return None
+    return abs(record.get('error', 0.0)) + max(0.0, now - record['synced']) / 86400.0 * drift
+
+# Syncs the sign's clock to the host's.  Returns the message for the user.  clock and sleep are there for
+# testing.
+def sync_clock(conn, addr=SIGN_ADDRESS_BROADCAST, sign=None, threshold=None, drift=CLOCK_DRIFT, clock=time.time, sleep=time.sleep):
+    if sign is None:
+        sign = conn.name
+    state = load_state(CLOCK_FILE, {})
+    record = state.get(sign)
+
+    if threshold is not None:
+        error = estimated_drift(record, clock(), drift)
+        if error is not None and error <= threshold:
+            return "Sign clock should be within %.1fs; not synced." % error
+
+    # The packet is the same length whatever the time, and opening the link isn't part of the wait.
+    with conn.lock:
+        conn.open()
+    latency = sync_latency(conn, frame_len(clock_payloads()), record)
+    target = (int((clock() + latency) // 60) + 1) * 60
+    sleep(max(0.0, target - latency - clock()))
+
+    payloads = clock_payloads(target)
+    start = time.perf_counter()
+    transmit_batch(payloads, addr, conn=conn)
+    took = time.perf_counter() - start
+    error = clock() - target
+    METRICS.observe('clock_sync', took, sign=conn.name)
+    METRICS.observe('clock_sync_error', abs(error), sign=conn.name)
+
+    if record is not None and 'latency' in record:
+        took = CLOCK_LATENCY_WEIGHT * took + (1 - CLOCK_LATENCY_WEIGHT) * record['latency']
+    state[sign] = {'synced': target + error, 'latency': took, 'error': error}
+    save_state(CLOCK_FILE, state)
+
+    fields = clock_fields(target)
+    return "Sign clock set to %s %s (day %s), landing %+.3fs from the minute." % (fields['time'], fields['date'], fields['day'], error)
+
+# TJBChris - Counters.  The sign has five counters that it steps by itself every minute, hour or day, from a start
+# value towards a target, and [counter1]-[counter5] show them in a TEXT.  A tally or countdown then costs one
+# command to set up and nothing after that.  Set Counter (E5) carries the counter number ("1"-"5"), a control
+# byte, and the start, step, current and target values as eight decimal digits each.  Setting a counter restarts
+# it at the start value.
+COUNTER_ON           = 0x80         # Control byte - counting enabled
+COUNTER_INCREMENT    = 0x40         # Control byte - count up (clear to count down)
+COUNTER_DIGITS       = 8
+COUNTER_MAX          = 10 ** COUNTER_DIGITS - 1
+COUNTER_SCHEDULES    = {'minute': 0x20, 'hour': 0x10, 'day': 0x08, 'off': 0}
+
+# A negative step counts down.  The target defaults to the end the counter is heading for; 'off' sets the value
+# without counting.
+def set_counter(number, start=0, step=1, target=None, every='minute'):
+    number = str(number)
+    if number not in ('1', '2', '3', '4', '5'):
+        raise Exception("Counter must be 1 to 5.  Got: " + number)
+    if every not in COUNTER_SCHEDULES:
+        raise Exception("Counters step every " + ", ".join(k for k in COUNTER_SCHEDULES if k != 'off') + " (or off).  Got: " + str(every))
+    if target is None:
+        target = 0 if step < 0 else COUNTER_MAX
+    for (name, value) in (('start', start), ('step', abs(step)), ('target', target)):
+        if not 0 <= value <= COUNTER_MAX:
+            raise Exception("Counter %s must be 0 to %d.  Got: %d" % (name, COUNTER_MAX, value))
+
+    control = COUNTER_SCHEDULES[every]
+    if every != 'off':
+        control |= COUNTER_ON
+    if step >= 0:
+        control |= COUNTER_INCREMENT
+    values = b''.join(b"%0*d" % (COUNTER_DIGITS, v) for v in (start, abs(step), start, target))
+    return COMMAND_WRITE_SPECIAL + SET_COUNTER + bytes(number, 'latin-1') + bytes([control]) + values
+
+# Counter settings given as name=value (start=100 step=-1 target=0 every=minute), as for --mode setcounter.
+def parse_counter_settings(pairs):
+    settings = {}
+    for pair in pairs:
+        (name, sep, value) = pair.partition('=')
+        if sep == '' or name not in ('start', 'step', 'target', 'every'):
+            raise Exception("Counter settings are start=N, step=N, target=N and every=minute|hour|day|off.  Got: " + pair)
+        if name == 'every':
+            settings[name] = value
+        else:
+            try:
+                settings[name] = int(value)
+            except ValueError:
+                raise Exception("Counter " + name + " must be a whole number.  Got: " + value)
+    return settings
     
 # TJBChris - Parse String Values
 # Strings have limited formatting options/substitutions available.  For now, we're doing text only, w/ room for expansion.
 def write_string(reqdata, label):
 
-    outBytes = COMMAND_WRITE_STRING + bytes(label,'utf-8')
+    outBytes = [COMMAND_WRITE_STRING + bytes(label,'utf-8')]
 
     for d in reqdata:
-        outBytes += bytes(d,'utf-8')
-
-    return outBytes
-
+        outBytes.append(transcode(d))
+
+    return b''.join(outBytes)
+
+
+# TJBChris - DOTS pictures.  A DOTS file is a small bitmap stored on the sign: "I", the label, its height and width
+# (two hex digits each), then one line of pixel codes per row, each ending in a CR.  Pictures are quantized to the
+# sign's eight colors (nearest color wins) and shown from TEXT with [dotsX].  Sources can be a PPM/PGM file, which
+# is read here, a PNG or anything else Pillow opens, a Pillow image, or a NumPy array (height x width, x3 for RGB
+# or x4 for RGBA).  NumPy is used for the quantization when it's installed; it's optional, as is Pillow.
+#
+# Encoding a picture isn't free and pictures rarely change, so the encoded rows are cached in ~/.betabrite/dots by
+# a hash of the source (the file's bytes, or the array's).  The shadow store tracks DOTS labels too, so an
+# unchanged picture isn't sent again.
+DOTS_CACHE_DIR       = 'dots'
+DOTS_CACHE_MAX       = 256          # encoded pictures kept; the least recently used go first
+DOTS_MAX_HEIGHT      = 31
+DOTS_MAX_WIDTH       = 255
+DOTS_COLOR_STATUS    = '4000'       # memory configuration: eight-color picture
+
+# Pixel code -> (r, g, b), in the order the quantizer breaks ties.
+DOTS_PALETTE = [
+    (b'0', (0, 0, 0)),              # off
+    (b'1', (255, 0, 0)),            # red
+    (b'2', (0, 255, 0)),            # green
+    (b'3', (255, 176, 0)),          # amber
+    (b'4', (128, 0, 0)),            # dim red
+    (b'5', (0, 128, 0)),            # dim green
+    (b'6', (128, 64, 0)),           # brown
+    (b'7', (255, 112, 0)),          # orange
+    (b'8', (255, 255, 0)),          # yellow
+]
+
+PNM_TOKEN            = re.compile(rb"\s*(?:#[^\n]*\n\s*)*(\S+)")
+
+# Reads a binary or ASCII PPM (P6/P3) or PGM (P5/P2) without needing Pillow.  Returns (height, width, rgb), with rgb
+# as height*width*3 bytes.
+def read_pnm(data):
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        match = PNM_TOKEN.match(data, pos)
+        if match is None:
+            raise Exception("Not a PPM/PGM picture (truncated header).")
+        tokens.append(match.group(1))
+        pos = match.end()
+    (magic, width, height, maxval) = (tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3]))
+    if magic not in (b'P2', b'P3', b'P5', b'P6'):
+        raise Exception("Not a PPM/PGM picture (magic " + repr(magic) + ").  Only P2, P3, P5 and P6 are supported.")
+    channels = 3 if magic in (b'P3', b'P6') else 1
+    count = width * height * channels
+
+    if magic in (b'P5', b'P6'):
+        # Exactly one whitespace byte separates the header from the raster.
+        raster = data[pos+1:]
+        if maxval > 255:
+            if len(raster) < count * 2:
+                raise Exception("PPM/PGM picture is truncated.")
+            values = [(raster[i] << 8 | raster[i+1]) for i in range(0, count * 2, 2)]
+        else:
+            values = raster[:count]
+    else:
+        values = [int(v) for v in data[pos:].split()[:count]]
+    if len(values) < count:
+        raise Exception("PPM/PGM picture is truncated.")
+    if maxval != 255:
+        values = [v * 255 // maxval for v in values]
+    if channels == 1:
+        values = [v for v in values for i in range(3)]
+    return (height, width, bytes(values))
+
+# Converts a NumPy array or Pillow image to (height, width, rgb).
+def picture_rgb(image):
+    if hasattr(image, 'convert'):
+        image = image.convert('RGB')
+        return (image.height, image.width, image.tobytes())
+
+    import numpy
+    a = numpy.asarray(image)
+    if a.dtype.kind == 'f':
+        a = a * 255 + 0.5
+    a = numpy.clip(a, 0, 255).astype(numpy.uint16)
+    if a.ndim == 2:
+        a = numpy.stack([a, a, a], axis=2)
+    elif a.ndim == 3 and a.shape[2] == 4:
+        # Transparent pixels are off.
+        a = a[:, :, :3] * a[:, :, 3:4] // 255
+    elif a.ndim != 3 or a.shape[2] != 3:
+        raise Exception("Pictures must be height x width, height x width x 3 (RGB) or height x width x 4 (RGBA).  Got shape %s." % (a.shape,))
+    return (a.shape[0], a.shape[1], a.astype(numpy.uint8).tobytes())
+
+# Loads a picture file as (height, width, rgb).
+def load_picture(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[0:1] == b'P' and data[1:2] in (b'2', b'3', b'5', b'6'):
+        return read_pnm(data)
+    try:
+        from PIL import Image
+    except ImportError:
+        raise Exception("Only PPM/PGM pictures can be read without Pillow.  For anaconda, run: conda install pillow")
+    import io
+    return picture_rgb(Image.open(io.BytesIO(data)))
+
+# Maps rgb (height*width*3 bytes) to DOTS rows: a pixel code per pixel and a CR after each row.
+def quantize_picture(height, width, rgb):
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        palette = numpy.array([color for (code, color) in DOTS_PALETTE], dtype=numpy.int32)
+        codes = numpy.frombuffer(b''.join(code for (code, color) in DOTS_PALETTE), dtype=numpy.uint8)
+        pixels = numpy.frombuffer(rgb, dtype=numpy.uint8).reshape(height * width, 1, 3).astype(numpy.int32)
+        nearest = ((pixels - palette[numpy.newaxis]) ** 2).sum(axis=2).argmin(axis=1)
+        rows = codes[nearest].reshape(height, width)
+        return numpy.hstack([rows, numpy.full((height, 1), CR[0], dtype=numpy.uint8)]).tobytes()
+
+    # No NumPy: one pixel at a time, but each distinct color is only looked up once.
+    seen = {}
+    out = bytearray()
+    for y in range(height):
+        for x in range(width):
+            i = (y * width + x) * 3
+            color = rgb[i:i+3]
+            code = seen.get(color)
+            if code is None:
+                code = min(DOTS_PALETTE, key=lambda entry: sum((a - b) ** 2 for (a, b) in zip(color, entry[1])))[0]
+                seen[color] = code
+            out += code
+        out += CR
+    return bytes(out)
+
+# Encodes a picture (a file path, a Pillow image or a NumPy array) to its DOTS data: height, width and rows.
+# Results are cached by a hash of the source.
+def encode_picture(source):
+    import hashlib
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            digest = hashlib.sha1(b'dots:file:' + f.read()).hexdigest()
+    else:
+        (height, width, rgb) = picture_rgb(source)
+        digest = hashlib.sha1(b'dots:%dx%d:' % (height, width) + rgb).hexdigest()
+
+    path = state_path(os.path.join(DOTS_CACHE_DIR, digest))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        pass
+
+    if isinstance(source, str):
+        (height, width, rgb) = load_picture(source)
+    if height < 1 or width < 1 or height > DOTS_MAX_HEIGHT or width > DOTS_MAX_WIDTH:
+        raise Exception("DOTS pictures can be up to %d rows by %d columns.  Got %d by %d." % (DOTS_MAX_HEIGHT, DOTS_MAX_WIDTH, height, width))
+    data = bytes("%0.2X%0.2X" % (height, width), 'latin-1') + quantize_picture(height, width, rgb)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    prune_dots_cache()
+    return data
+
+def prune_dots_cache(keep=DOTS_CACHE_MAX):
+    cacheDir = state_path(DOTS_CACHE_DIR)
+    paths = [os.path.join(cacheDir, name) for name in os.listdir(cacheDir) if not name.endswith('.tmp')]
+    if len(paths) <= keep:
+        return
+    paths.sort(key=lambda p: os.stat(p).st_mtime)
+    for p in paths[:len(paths) - keep]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+def write_dots(source, label):
+    return COMMAND_WRITE_DOTS + bytes(label, 'utf-8') + encode_picture(source)
+
+def read_dots(label, addr=SIGN_ADDRESS_BROADCAST, conn=None):
+    return read_request(COMMAND_READ_DOTS + label, addr, conn)[1:]
 
 ################################################################################
 
+# TJBChris - Tag table for parse_text_message.  Tag name (without brackets) -> (attribute, value).  'position',
+# 'color' and 'mode' tags start a new animation segment and set that attribute on it; 'insert' tags drop a
+# sign-side substitution (time, date, etc.) into the text.  [strX] (insert STRING X) and [dotsX] (insert DOTS
+# picture X) are handled separately since X can be any label.
+TEXT_TAGS = {
+    # TJBChris - original (though newly-reformatted) tags which manage mode, color, and position are grouped first.
+    # In Adaptive's protocol, these must come before any text or substitutions (time, date, temp., etc.)
+    'middle':       ('position', TEXT_POS_MIDDLE),
+    'top':          ('position', TEXT_POS_TOP),
+    'bottom':       ('position', TEXT_POS_BOTTOM),
+    'fill':         ('position', TEXT_POS_FILL),
+    'red':          ('color', TEXT_COLOR_RED),
+    'green':        ('color', TEXT_COLOR_GREEN),
+    'amber':        ('color', TEXT_COLOR_AMBER),
+    'dimred':       ('color', TEXT_COLOR_DIMRED),
+    'brown':        ('color', TEXT_COLOR_BROWN),
+    'orange':       ('color', TEXT_COLOR_ORANGE),
+    'yellow':       ('color', TEXT_COLOR_YELLOW),
+    'rainbow1':     ('color', TEXT_COLOR_RAINBOW1),
+    'rainbow2':     ('color', TEXT_COLOR_RAINBOW2),
+    'mix':          ('color', TEXT_COLOR_MIX),
+    'autocolor':    ('color', TEXT_COLOR_AUTO),
+    'rotate':       ('mode', MODE_ROTATE),
+    'hold':         ('mode', MODE_HOLD),
+    'flash':        ('mode', MODE_FLASH),
+    'rollup':       ('mode', MODE_ROLLUP),
+    'rolldown':     ('mode', MODE_ROLLDOWN),
+    'rollleft':     ('mode', MODE_ROLLLEFT),
+    'rollright':    ('mode', MODE_ROLLRIGHT),
+    'wipeup':       ('mode', MODE_WIPEUP),
+    'wipedown':     ('mode', MODE_WIPEDOWN),
+    'wipeleft':     ('mode', MODE_WIPELEFT),
+    'wiperight':    ('mode', MODE_WIPERIGHT),
+    'scroll':       ('mode', MODE_SCROLL),
+    'automode':     ('mode', MODE_AUTO),
+    'rollin':       ('mode', MODE_ROLLIN),
+    'rollout':      ('mode', MODE_ROLLOUT),
+    'wipein':       ('mode', MODE_WIPEIN),
+    'wipeout':      ('mode', MODE_WIPEOUT),
+    'cmprsrot':     ('mode', MODE_CMPRSROT),
+    'twinkle':      ('mode', MODE_TWINKLE),
+    'sparkle':      ('mode', MODE_SPARKLE),
+    'snow':         ('mode', MODE_SNOW),
+    'interlock':    ('mode', MODE_INTERLOCK),
+    'switch':       ('mode', MODE_SWITCH),
+    'spray':        ('mode', MODE_SPRAY),
+    'starburst':    ('mode', MODE_STARBURST),
+    'welcome':      ('mode', MODE_WELCOME),
+    'slotmachine':  ('mode', MODE_SLOTMACHINE),
+    'newsflash':    ('mode', MODE_NEWSFLASH),
+    'trumpet':      ('mode', MODE_TRUMPET),
+    'thankyou':     ('mode', MODE_THANKYOU),
+    'nosmoking':    ('mode', MODE_NOSMOKING),
+    'drinkdrive':   ('mode', MODE_DRINKDRIVE),
+    'animal':       ('mode', MODE_ANIMAL),
+    'fish':         ('mode', MODE_FISH),
+    'fireworks':    ('mode', MODE_FIREWORKS),
+    'turbocar':     ('mode', MODE_TURBOCAR),
+    'balloons':     ('mode', MODE_BALLOONS),
+    'cherrybomb':   ('mode', MODE_CHERRYBOMB),
+
+    # TJBChris - Additional color/mode/position tags as they are needed.
+    'blue':         ('color', TEXT_COLOR_BLUE),
+
+    # TJBChris - In-text replacement tags start here (time, date, string substitutions, etc.); the result of these must replace the tag text.
+    'time':         ('insert', CURTIME_INSERT.decode()),
+    'usdate':       ('insert', CURDATE_MMDDYY_SLASH.decode()),
+    'timeday':      ('insert', CURDATE_WEEKDAYY.decode() + ' ' + CURTIME_INSERT.decode()),
+    'counter1':     ('insert', COUNTER_1.decode()),
+    'counter2':     ('insert', COUNTER_2.decode()),
+    'counter3':     ('insert', COUNTER_3.decode()),
+    'counter4':     ('insert', COUNTER_4.decode()),
+    'counter5':     ('insert', COUNTER_5.decode()),
+}
+
+# Tag regex.  The capture group makes re.split() hand back the tag names between the text pieces.
+TAG_PATTERN = re.compile(r"\[([a-zA-Z0-9]{2,12})\]")
+
 def parse_text_message(tokens):
     animations = []
-    text = ''
+    text = []
     mode = MODE_AUTO
     color = TEXT_COLOR_AUTO
     position = TEXT_POS_MIDDLE
 
-    # Tag regex
-    tagRegex = r"^\[[a-zA-Z0-9]{2,12}\]$"
+    # Tags no longer need spaces around them: the tokens are joined back together and split on the tags
+    # themselves.  pieces alternates text, tag name, text, tag name, ..., text.
+    pieces = TAG_PATTERN.split(' '.join([tok for tok in tokens if len(tok) > 0]))
+
+    for i in range(len(pieces)):
+        piece = pieces[i]
+
+        # Text.  Spaces next to a tag are separators, not content (as when every tag was its own token), except
+        # that text following an insert still gets one space between them.  Text glued to a tag stays glued.
+        if i % 2 == 0:
+            words = piece.strip(' ')
+            if words == '':
+                continue
+            if text and piece[0] == ' ':
+                text.append(' ')
+            text.append(words)
+            continue
+
+        tag = TEXT_TAGS.get(piece)
 
-    # String replacement tag regex ([strd] for string d, [str3] for string 3, etc.)
-    strTagRegex = r"^\[str.\]$"
+        # Insert STRING value ([strd] for string d, [str3] for string 3, etc.).  Doesn't break the segment.
+        if tag is None and len(piece) == 4 and piece.startswith('str'):
+            text.append(STRING_FILE_INSERT.decode() + piece[3])
+            continue
 
-    for tok in tokens:
-        if len(tok) == 0:
+        # Insert DOTS picture ([dotsP] for picture P).  Doesn't break the segment either.
+        if tag is None and len(piece) == 5 and piece.startswith('dots'):
+            text.append(DOTS_INSERT.decode() + piece[4])
             continue
 
-        if re.match(tagRegex, tok):
-            if text != '' and not re.match(strTagRegex, tok):
-                animations.append(animation(text, mode, color, position))
-                text = ''
-                mode = MODE_AUTO
-                color = TEXT_COLOR_AUTO
-                position = TEXT_POS_MIDDLE
-
-            # TJBChris - original (though newly-reformatted) tags which manage mode, color, and position are grouped first.
-            # In Adaptive's protocol, these must come before any text or substitutions (time, date, temp., etc.)
-            if tok == '[middle]':
-                position = TEXT_POS_MIDDLE
-            elif tok == '[top]':
-                position = TEXT_POS_TOP
-            elif tok == '[bottom]':
-                position = TEXT_POS_BOTTOM
-            elif tok == '[fill]':
-                position = TEXT_POS_FILL
-            elif tok == '[red]':
-                color = TEXT_COLOR_RED
-            elif tok == '[green]':
-                color = TEXT_COLOR_GREEN
-            elif tok == '[amber]':
-                color = TEXT_COLOR_AMBER
-            elif tok == '[dimred]':
-                color = TEXT_COLOR_DIMRED
-            elif tok == '[brown]':
-                color = TEXT_COLOR_BROWN
-            elif tok == '[orange]':
-                color = TEXT_COLOR_ORANGE
-            elif tok == '[yellow]':
-                color = TEXT_COLOR_YELLOW
-            elif tok == '[rainbow1]':
-                color = TEXT_COLOR_RAINBOW1
-            elif tok == '[rainbow2]':
-                color = TEXT_COLOR_RAINBOW2
-            elif tok == '[mix]':
-                color = TEXT_COLOR_MIX
-            elif tok == '[autocolor]':
-                color = TEXT_COLOR_AUTO
-            elif tok == '[rotate]':
-                mode = MODE_ROTATE
-            elif tok == '[hold]':
-                mode = MODE_HOLD
-            elif tok == '[flash]':
-                mode = MODE_FLASH
-            elif tok == '[rollup]':
-                mode = MODE_ROLLUP
-            elif tok == '[rolldown]':
-                mode = MODE_ROLLDOWN
-            elif tok == '[rollleft]':
-                mode = MODE_ROLLLEFT
-            elif tok == '[rollright]':
-                mode = MODE_ROLLRIGHT
-            elif tok == '[wipeup]':
-                mode = MODE_WIPEUP
-            elif tok == '[wipedown]':
-                mode = MODE_WIPEDOWN
-            elif tok == '[wipeleft]':
-                mode = MODE_WIPELEFT
-            elif tok == '[wiperight]':
-                mode = MODE_WIPERIGHT
-            elif tok == '[scroll]':
-                mode = MODE_SCROLL
-            elif tok == '[automode]':
-                mode = MODE_AUTO
-            elif tok == '[rollin]':
-                mode = MODE_ROLLIN
-            elif tok == '[rollout]':
-                mode = MODE_ROLLOUT
-            elif tok == '[wipein]':
-                mode = MODE_WIPEIN
-            elif tok == '[wipeout]':
-                mode = MODE_WIPEOUT
-            elif tok == '[cmprsrot]':
-                mode = MODE_CMPRSROT
-            elif tok == '[twinkle]':
-                mode = MODE_TWINKLE
-            elif tok == '[sparkle]':
-                mode = MODE_SPARKLE
-            elif tok == '[snow]':
-                mode = MODE_SNOW
-            elif tok == '[interlock]':
-                mode = MODE_INTERLOCK
-            elif tok == '[switch]':
-                mode = MODE_SWITCH
-            elif tok == '[spray]':
-                mode = MODE_SPRAY
-            elif tok == '[starburst]':
-                mode = MODE_STARBURST
-            elif tok == '[welcome]':
-                mode = MODE_WELCOME
-            elif tok == '[slotmachine]':
-                mode = MODE_SLOTMACHINE
-            elif tok == '[newsflash]':
-                mode = MODE_NEWSFLASH
-            elif tok == '[trumpet]':
-                mode = MODE_TRUMPET
-            elif tok == '[thankyou]':
-                mode = MODE_THANKYOU
-            elif tok == '[nosmoking]':
-                mode = MODE_NOSMOKING
-            elif tok == '[drinkdrive]':
-                mode = MODE_DRINKDRIVE
-            elif tok == '[animal]':
-                mode = MODE_ANIMAL
-            elif tok == '[fish]':
-                mode = MODE_FISH
-            elif tok == '[fireworks]':
-                mode = MODE_FIREWORKS
-            elif tok == '[turbocar]':
-                mode = MODE_TURBOCAR
-            elif tok == '[balloons]':
-                mode = MODE_BALLOONS
-            elif tok == '[cherrybomb]':
-                mode = MODE_CHERRYBOMB
-
-            # TJBChris - Additional color/mode/position tags as they are needed.
-            elif tok == '[blue]':
-                color = TEXT_COLOR_BLUE
-
-            # TJBChris - In-text replacement tags start here (time, date, string substitutions, etc.); the result of these must replace the tag text.
-            elif tok == '[time]':
-                text += CURTIME_INSERT.decode()
-            elif tok == '[usdate]':
-                text += CURDATE_MMDDYY_SLASH.decode()
-            elif tok == '[timeday]':
-                text += CURDATE_WEEKDAYY.decode() + ' ' + CURTIME_INSERT.decode()
-            # Insert STRING value.
-            elif re.match(strTagRegex, tok):
-                text += STRING_FILE_INSERT.decode() + tok[4]
+        if text:
+            animations.append(animation(''.join(text), mode, color, position))
+            text = []
+            mode = MODE_AUTO
+            color = TEXT_COLOR_AUTO
+            position = TEXT_POS_MIDDLE
+
+        # Unknown tags end the segment and are otherwise ignored.
+        if tag is None:
+            continue
 
+        (attribute, value) = tag
+        if attribute == 'position':
+            position = value
+        elif attribute == 'color':
+            color = value
+        elif attribute == 'mode':
+            mode = value
         else:
-            if len(text) > 0:
-                text += ' '
-            text += tok
+            text.append(value)
 
-    animations.append(animation(text, mode, color, position))
+    animations.append(animation(''.join(text), mode, color, position))
 
     return animations
 
+# TJBChris - Templates.  A message like "CPU: {cpu}%" is split into the part that never changes (a TEXT file, sent
+# once, with [strX] inserts where the placeholders were) and the part that does (one STRING per placeholder).  After
+# that, a new value is a STRING write of a few bytes instead of resending (and blanking) the whole TEXT file.  Each
+# placeholder name is given a STRING label the first time it is seen, and keeps it; the assignments are stored in
+# fields.json so later runs (and --mode values) agree on them.  Labels come from TEMPLATE_STRING_LABELS, so keep
+# your TEXT labels out of that range (A-Z is safe).  Labels the shadow store knows to be taken (STRINGs you've
+# written yourself, TEXT and DOTS labels in the memory layout) are never handed out, and STRING labels the layout
+# has room for but nothing uses yet are handed out first (see template_labels).
+FIELDS_FILE              = 'fields.json'
+TEMPLATE_STRING_LABELS   = '123456789abcdefghijklmnopqrstuvwxyz'
+PLACEHOLDER_PATTERN      = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+_fields_lock = threading.Lock()
+
+def load_fields():
+    return load_state(FIELDS_FILE, {})
+
+# What the shadow store knows about labels, across every sign: (taken, configured).  taken holds the STRING labels
+# written directly (not by a template; fields are the template assignments) and every TEXT and DOTS label in a
+# memory layout, since all three kinds share one set of labels.  configured holds the STRING labels in a layout.
+def template_labels(fields, shadow=None):
+    if shadow is None:
+        shadow = ShadowStore()
+    taken = set()
+    configured = set()
+    for sign in list(shadow.signs):
+        taken.update(key[len('string:'):] for key in shadow.signs[sign] if key.startswith('string:'))
+        for entry in shadow.get_layout(sign) or []:
+            if entry.kind == 'string':
+                configured.add(entry.label)
+            else:
+                taken.add(entry.label)
+    return (taken - set(fields.values()), configured)
+
+# Returns {name: label} for the placeholder names, assigning free STRING labels to names not seen before (never
+# one in reserved, e.g. the template's own TEXT label, or one that's taken; configured but unused STRING labels
+# first).  The second value is the list of names that were new.
+def allocate_fields(names, reserved='', shadow=None):
+    with _fields_lock:
+        fields = load_fields()
+        new = [name for name in dict.fromkeys(names) if name not in fields]
+        if new:
+            (taken, configured) = template_labels(fields, shadow)
+            free = [l for l in TEMPLATE_STRING_LABELS if l not in fields.values() and l not in reserved and l not in taken]
+            free.sort(key=lambda l: l not in configured)
+            if len(free) < len(new):
+                raise Exception("Out of STRING labels for template fields (" + ", ".join(sorted(fields)) + " already have one).  Remove unused ones from " + state_path(FIELDS_FILE) + ".")
+            for (name, label) in zip(new, free):
+                fields[name] = label
+            save_state(FIELDS_FILE, fields)
+        return (dict((name, fields[name]) for name in names), new)
+
+# The payloads for a template: an empty STRING for each newly-assigned placeholder (so the sign doesn't show
+# whatever that label held before), followed by the TEXT file.
+def template_payloads(tokens, label):
+    names = [name for tok in tokens for name in PLACEHOLDER_PATTERN.findall(tok)]
+    if len(names) == 0:
+        raise Exception("The template has no {name} placeholders.  Use --mode text for fixed messages.")
+    (fields, new) = allocate_fields(names, reserved=label)
+    # The insert goes in as text rather than as a [strX] tag, so the spaces around the placeholder are kept.
+    tokens = [PLACEHOLDER_PATTERN.sub(lambda m: STRING_FILE_INSERT.decode() + fields[m.group(1)], tok) for tok in tokens]
+    payloads = [write_string([], fields[name]) for name in new]
+    payloads.append(list(iter_write_file(parse_text_message(tokens), bytes(label, 'utf-8'))))
+    return payloads
+
+# A warning about the template's STRING labels that no known memory layout has room for (the sign ignores writes to
+# those), or None if they're all configured or no layout is known.
+def unconfigured_fields_warning(payloads, shadow=None):
+    if shadow is None:
+        shadow = ShadowStore()
+    layouts = [shadow.get_layout(sign) for sign in list(shadow.signs)]
+    layouts = [layout for layout in layouts if layout is not None]
+    if not layouts:
+        return None
+    configured = set(entry.label for layout in layouts for entry in layout if entry.kind == 'string')
+    missing = [payload_head(p, 2)[1:2].decode('latin-1') for p in payloads if payload_head(p, 1) == COMMAND_WRITE_STRING]
+    missing = [label for label in missing if label not in configured]
+    if not missing:
+        return None
+    return "Warning: STRING label(s) " + ", ".join(missing) + " aren't in the sign's memory layout, so their values won't show.  Add them with cfgmem, or use --auto-memory."
+
+# STRING payloads for name=value pairs, using the labels the templates assigned.
+def value_payloads(pairs):
+    fields = load_fields()
+    payloads = []
+    for pair in pairs:
+        (name, sep, value) = pair.partition('=')
+        if sep == '':
+            raise Exception("Values are given as name=value.  Got: " + pair)
+        if name not in fields:
+            raise Exception("No template uses {" + name + "}.  Known fields: " + (", ".join(sorted(fields)) or "none") + ".")
+        payloads.append(write_string([value], fields[name]))
+    return payloads
+
+# TJBChris - Display-time estimates.  Works out how wide each segment of a compiled TEXT file is (in LED columns)
+# and roughly how long the sign spends on it, so a run sequence can be timed without standing in front of it, and
+# a STRING can be refreshed just before the text that shows it comes around.  Rotating modes take as long as it
+# takes the text to scroll through at the current speed; every other mode shows the text a page (a screenful, or up
+# to a new line) at a time, for a transition plus a hold.  The figures are estimates: glyph widths come from the
+# tables below, and speeds and hold times from a DisplayModel, which can be tuned for your sign in display.json.
+DISPLAY_FILE         = 'display.json'
+DISPLAY_COLUMNS      = 80
+TEXT_COLOR_RGB_CODES = (b'Z', b'Y')         # After \x1c: RGB text color, RGB shadow color (RRGGBB follows)
+
+# Glyph widths (columns, not counting the one-column gap after each character) in the 7-high normal set for the
+# characters that aren't the default width.  The other character sets are scaled from it.
+GLYPHS_7_HIGH = {' ': 3, '!': 1, '"': 3, "'": 1, '(': 3, ')': 3, ',': 2, '.': 2, ':': 2, ';': 2, '[': 3, ']': 3,
+                 '`': 2, '|': 1, '1': 3, 'I': 3, 'i': 1, 'j': 4, 'l': 3, 'r': 4, 't': 4, '-': 4}
+
+def glyph_table(default, delta):
+    return (default, dict((c, max(1, w + delta)) for (c, w) in GLYPHS_7_HIGH.items()))
+
+# Character set code -> (default width, {character: width}).
+GLYPH_WIDTHS = {
+    CHARSET_5_NORMAL[1:2]:    glyph_table(4, -1),
+    CHARSET_7_NORMAL[1:2]:    glyph_table(5, 0),
+    CHARSET_7_FANCY[1:2]:     glyph_table(5, 0),
+    CHARSET_10_NORMAL[1:2]:   glyph_table(6, 1),
+    CHARSET_FULL_FANCY[1:2]:  glyph_table(6, 1),
+    CHARSET_FULL_NORMAL[1:2]: glyph_table(6, 1),
+}
+DEFAULT_CHARSET      = CHARSET_7_NORMAL[1:2]
+
+# What the sign-side inserts typically expand to, for measuring.
+INSERT_SAMPLES = {
+    CURTIME_INSERT:         '12:00PM',
+    CURDATE_MMDDYY_SLASH:   '12/31/26',
+    CURDATE_DDMMYY_SLASH:   '31/12/26',
+    CURDATE_MMDDYY_DASH:    '12-31-26',
+    CURDATE_DDMMYY_DASH:    '31-12-26',
+    CURDATE_MMDDYY_DOT:     '12.31.26',
+    CURDATE_DDMMYY_DOT:     '31.12.26',
+    CURDATE_MMDDYY_SPACE:   '12 31 26',
+    CURDATE_DDMMYY_SPACE:   '31 12 26',
+    CURDATE_MMMDDYYYY:      'DEC.31, 2026',
+    CURDATE_WEEKDAYY:       'WEDNESDAY',
+    TEMP_CELSIUS:           '-10C',
+    TEMP_FAHRENHEIT:        '100F',
+    COUNTER_1:              '00000',
+    COUNTER_2:              '00000',
+    COUNTER_3:              '00000',
+    COUNTER_4:              '00000',
+    COUNTER_5:              '00000',
+}
+
+SCROLL_MODES         = (MODE_ROTATE, MODE_CMPRSROT)
+HOLD_MODES           = (MODE_HOLD, MODE_FLASH)
+# Special modes that present the text (the rest are stand-alone animations).
+TEXT_SPECIAL_MODES   = (MODE_TWINKLE, MODE_SPARKLE, MODE_SNOW, MODE_INTERLOCK, MODE_SWITCH, MODE_SLIDE, MODE_SPRAY, MODE_STARBURST)
+
+# One segment of a TEXT file: its mode, width in columns, pages (screenfuls) for non-rotating modes, the STRING
+# labels it inserts, and the estimated seconds on the sign.
+TextSegment = collections.namedtuple('TextSegment', ['mode', 'columns', 'pages', 'strings', 'duration'])
+# One label's turn in a run sequence, start and duration in seconds from the start of the cycle.
+SequenceSlot = collections.namedtuple('SequenceSlot', ['label', 'start', 'duration', 'strings'])
+
+class DisplayModel:
+
+    # scrollSpeeds: columns per second for SPEED_1 (slowest) to SPEED_5.  holdTime: seconds each page is held.
+    # transitionTime: seconds a page takes to come in.  animationTime: seconds for a stand-alone special animation.
+    def __init__(self, columns=DISPLAY_COLUMNS, scrollSpeeds=(10, 14, 20, 28, 40), defaultSpeed=5, holdTime=3.0, transitionTime=1.0, animationTime=4.0):
+        if len(scrollSpeeds) != 5 or min(scrollSpeeds) <= 0:
+            raise Exception("scrollSpeeds needs five positive speeds (columns per second), for speeds 1 to 5.  Got: " + repr(scrollSpeeds))
+        self.columns = columns
+        self.scrollSpeeds = list(scrollSpeeds)
+        self.defaultSpeed = defaultSpeed
+        self.holdTime = holdTime
+        self.transitionTime = transitionTime
+        self.animationTime = animationTime
+
+    def __repr__(self):
+        return "DisplayModel(columns=%d, scrollSpeeds=%r, defaultSpeed=%d, holdTime=%g, transitionTime=%g, animationTime=%g)" % (self.columns, self.scrollSpeeds, self.defaultSpeed, self.holdTime, self.transitionTime, self.animationTime)
+
+    # Seconds for a segment of the given mode, width and page count, at speed 1-5, optionally with no hold.
+    def duration(self, mode, columns, pages, speed, hold=True):
+        holdTime = self.holdTime if hold else 0
+        if mode in SCROLL_MODES:
+            return (columns + self.columns) / float(self.scrollSpeeds[speed - 1])
+        if mode in HOLD_MODES:
+            return pages * holdTime
+        if mode.startswith(b'n') and mode not in TEXT_SPECIAL_MODES:
+            return self.animationTime
+        return pages * (self.transitionTime + holdTime)
+
+    def to_dict(self):
+        return {'columns': self.columns, 'scrollSpeeds': self.scrollSpeeds, 'defaultSpeed': self.defaultSpeed, 'holdTime': self.holdTime, 'transitionTime': self.transitionTime, 'animationTime': self.animationTime}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(int(d['columns']), [float(s) for s in d['scrollSpeeds']], int(d['defaultSpeed']), float(d['holdTime']), float(d['transitionTime']), float(d['animationTime']))
+
+    @classmethod
+    def load(cls, name=DISPLAY_FILE):
+        d = load_state(name)
+        if d is None:
+            return cls()
+        try:
+            return cls.from_dict(d)
+        except (KeyError, TypeError, ValueError):
+            return cls()
+
+    def save(self, name=DISPLAY_FILE):
+        save_state(name, self.to_dict())
+
+# Columns taken by text in a character set, with the wide / double-width / fixed-width attributes given.
+def text_columns(text, charset=DEFAULT_CHARSET, wide=False, fixed=False):
+    (default, widths) = GLYPH_WIDTHS.get(charset, GLYPH_WIDTHS[DEFAULT_CHARSET])
+    columns = 0
+    for c in text:
+        w = default if fixed else widths.get(c, default)
+        columns += (w * 2 if wide else w) + 1
+    return columns
+
+# Splits a compiled TEXT file (a write_file() payload, or just what follows the label) into TextSegments.
+# strings maps STRING labels to their current values and pictures maps DOTS labels to their widths; inserts of
+# unknown ones count as empty.
+def measure_text(payload, model=None, strings=None, pictures=None):
+    if model is None:
+        model = DisplayModel.load()
+    data = b''.join(payload_pieces(payload))
+    if data[0:1] == COMMAND_WRITE_TEXT:
+        data = data[2:]
+    strings = strings or {}
+    pictures = pictures or {}
+
+    segments = []
+    state = {}
+
+    def finish():
+        if not state:
+            return
+        pages = sum(max(1, -(-line // model.columns)) for line in state['lines'])
+        duration = model.duration(state['mode'], sum(state['lines']), pages, state['speed'], state['hold'])
+        segments.append(TextSegment(state['mode'], sum(state['lines']), pages, state['strings'], duration))
+
+    charset = DEFAULT_CHARSET
+    (wide, fixed) = (False, False)
+    i = 0
+    while i < len(data):
+        b = data[i:i+1]
+        if b == SOM:
+            finish()
+            mode = data[i+2:i+3]
+            if mode == b'n':
+                mode = data[i+2:i+4]
+            state.clear()
+            state.update(mode=mode, lines=[0], speed=model.defaultSpeed, hold=True, strings=[])
+            i += 2 + len(mode)
+            continue
+        if not state:
+            state.update(mode=MODE_AUTO, lines=[0], speed=model.defaultSpeed, hold=True, strings=[])
+
+        text = ''
+        if b in (CR, NEW_PAGE):
+            # Rotating modes run lines together; the rest start a new page.
+            if state['mode'] in SCROLL_MODES:
+                text = ' '
+            else:
+                state['lines'].append(0)
+            i += 1
+        elif SPEED_1 <= b <= SPEED_5:
+            state['speed'] = data[i] - SPEED_1[0] + 1
+            i += 1
+        elif b == NO_HOLD_SPEED:
+            state['hold'] = False
+            i += 1
+        elif b == WIDE_CHARS_ON or b == WIDE_CHARS_OFF:
+            wide = b == WIDE_CHARS_ON
+            i += 1
+        elif b == CHARSET_5_NORMAL[0:1]:
+            charset = data[i+1:i+2]
+            i += 2
+        elif b == FIXED_WIDTH_ON[0:1]:
+            fixed = data[i+1:i+2] == FIXED_WIDTH_ON[1:2]
+            i += 2
+        elif b == CHAR_ATTRIB_WIDE_ON[0:1]:
+            if data[i+1:i+2] in (CHAR_ATTRIB_WIDE_ON[1:2], CHAR_ATTRIB_DBLW_ON[1:2]):
+                wide = data[i+2:i+3] == b'1'
+            elif data[i+1:i+2] == CHAR_ATTRIB_FIX_ON[1:2]:
+                fixed = data[i+2:i+3] == b'1'
+            i += 3
+        elif b == STRING_FILE_INSERT:
+            label = data[i+1:i+2].decode('latin-1')
+            state['strings'].append(label)
+            value = strings.get(label, b'')
+            text = value.decode('latin-1') if isinstance(value, bytes) else value
+            i += 2
+        elif b == DOTS_INSERT:
+            state['lines'][-1] += pictures.get(data[i+1:i+2].decode('latin-1'), 0)
+            i += 2
+        elif b == CURTIME_INSERT:
+            text = INSERT_SAMPLES[CURTIME_INSERT]
+            i += 1
+        elif data[i:i+2] in INSERT_SAMPLES:
+            text = INSERT_SAMPLES[data[i:i+2]]
+            i += 2
+        elif b == ALPHA_DOTS_INSERT:
+            i += 15
+        elif b == XC_c[0:1]:
+            # Extended character: one glyph of the default width.
+            text = 'X'
+            i += 2
+        elif b == TEXT_COLOR_RED[0:1] and data[i+1:i+2] in TEXT_COLOR_RGB_CODES:
+            # RGB color (as TEXT_COLOR_BLUE): the code and six hex digits.
+            i += 8
+        elif b in (DBL_HEIGHT_CHARS_ON[0:1], TRUE_DESCENDERS_ON[0:1], CHAR_FLASH_ON[0:1], CURDATE_WEEKDAYY[0:1], TEXT_COLOR_RED[0:1]):
+            i += 2
+        elif data[i] < 0x20:
+            i += 1
+        else:
+            text = b.decode('latin-1')
+            i += 1
+
+        if text:
+            columns = text_columns(text, charset, wide, fixed)
+            if state['mode'] == MODE_CMPRSROT:
+                columns = columns * 2 // 3
+            state['lines'][-1] += columns
+    finish()
+    return segments
+
+# Estimated seconds the sign spends on a TEXT file per pass.
+def text_duration(payload, model=None, strings=None, pictures=None):
+    return sum(segment.duration for segment in measure_text(payload, model, strings, pictures))
+
+# Lays out one cycle of a run sequence from a list of payloads (as from a batch): the TEXT files, the current
+# STRING values and DOTS sizes, and the run sequence, which may instead be given as the labels in order.  With
+# no sequence at all, the TEXT files are taken in the order given.  Returns a list of SequenceSlot.
+def estimate_sequence(payloads, sequence=None, model=None):
+    if model is None:
+        model = DisplayModel.load()
+    (texts, strings, pictures) = ({}, {}, {})
+    for payload in payloads:
+        head = payload_head(payload, 6)
+        label = head[1:2].decode('latin-1')
+        if head[0:1] == COMMAND_WRITE_TEXT:
+            texts[label] = payload
+        elif head[0:1] == COMMAND_WRITE_STRING:
+            strings[label] = b''.join(payload_pieces(payload))[2:]
+        elif head[0:1] == COMMAND_WRITE_DOTS and len(head) == 6:
+            pictures[label] = int(head[4:6], 16)
+        elif head[0:2] == COMMAND_WRITE_SPECIAL + SET_SEQUENCE and sequence is None:
+            # Run type and keyboard lock come before the labels.
+            sequence = b''.join(payload_pieces(payload))[4:].decode('latin-1')
+    if sequence is None:
+        sequence = ''.join(texts)
+
+    slots = []
+    start = 0.0
+    for label in sequence:
+        if label not in texts:
+            continue
+        segments = measure_text(texts[label], model, strings, pictures)
+        duration = sum(s.duration for s in segments)
+        slots.append(SequenceSlot(label, start, duration, sorted(set(l for s in segments for l in s.strings))))
+        start += duration
+    return slots
+
+# Seconds from now until a text showing STRING label next comes up, given how far into the cycle the sign is.
+# None if nothing in the sequence shows it.
+def next_string_display(slots, label, elapsed=0.0):
+    cycle = sum(slot.duration for slot in slots)
+    starts = [slot.start for slot in slots if label in slot.strings]
+    if not starts or cycle <= 0:
+        return None
+    elapsed = elapsed % cycle
+    return min((start - elapsed) % cycle for start in starts)
+
 # sendRaw - Lets user specify all bytes betweeh STX and EOT.  See BetaBrite Alpha Protocol guide.  For un-implemented features and/or testing.
 def sendRaw(reqdata):
 
@@ -762,64 +3059,714 @@ def sendRaw(reqdata):
 
     return outBytes
 
-if __name__ == '__main__':
+# TJBChris - Command line parser.  Shared by the CLI and the daemon, which accepts the same operations.
+def build_parser():
     import argparse
 
     parser = argparse.ArgumentParser()
-    # USB BetaBrite PRISM - Supporting one sign on a system.  All have the same
-    # Vendor ID and Product ID (idVendor=8765, idProduct=1234, bcdDevice= 0.01)
+    # USB BetaBrite PRISM - All have the same Vendor ID and Product ID (idVendor=8765, idProduct=1234,
+    # bcdDevice= 0.01).  Use --list-signs / --register / --sign to drive more than one.
 
-    # This is commented out per the above comment (no need to specify a port...)
-    #parser.add_argument("--port", help="Port to write to", default='/dev/cu.usbserial-A4007B5o')
+    # TJBChris - --port is back, now selecting a transport rather than a serial device.  USB remains the default.
+    parser.add_argument("--port", help="Where the sign is: usb (default), serial:/dev/ttyUSB0[@9600], tcp:HOST:PORT, or file:PATH to record frames instead of sending them ('file:-' for stdout).  Default is " + DEFAULT_PORT + ".", default=DEFAULT_PORT)
 
     # TJBChris - Added label, clear, raw, runseq, and mode args (default is "settext").
-    parser.add_argument("--mode", help="Mode set: text, string, setdate, setday, settime, setsequence, cfgmem.  See doc.", default='text', choices=['text','string','setdate','settime','setsequence','setday','cfgmem'])
+    parser.add_argument("--address", help="Sign address (two hex digits, 00 is broadcast, ? is a wildcard).  Default is 00.", default=SIGN_ADDRESS_BROADCAST.decode())
+    parser.add_argument("--sign", help="Name of a registered sign to send to (see --register).  Repeat for several signs, which are all updated at once; 'all' means every registered sign.  Overrides --port and --address.", action='append')
+    parser.add_argument("--list-signs", help="Lists the PRISMs on the USB bus and the registered signs.  A dummy data element is required.", action="store_true")
+    parser.add_argument("--register", help="Registers the sign at --port (and --address) under this name for use with --sign.  A dummy data element is required.", metavar="NAME")
+    parser.add_argument("--mode", help="Mode set: text, textfile, template, values, string, dots, setdate, setday, settime, setsequence, setcounter, cfgmem.  See doc.", default='text', choices=['text','textfile','template','values','string','dots','setdate','settime','setsequence','setday','setcounter','cfgmem'])
     parser.add_argument("--label", help="Text or string label: Which message or string (A-Z, 0-9) you wish to update.  Default is A.  Message 0 is the priority message and will repeat until --runseq is used.", default='A')
     parser.add_argument("--raw", help="Allows sending of raw command code and matching data.  Automatically adds packet header/footer.  Requires at least two data parameters.  Ignores mode, label.", action="store_true")
     parser.add_argument("--runseq", help="Tells the sign to resume running the sequence.  Run this if the sign is stuck displaying the PRIORITY message (label 0).  Ignores all options.  Requires one dummy data element.", action="store_true")
     parser.add_argument("--clear", help="Clears all messages and strings.  Ignores all other arguments.  A dummy data element is required.", action="store_true")
+    parser.add_argument("--calibrate", help="Finds the fastest pacing (chunk size and delay) the sign accepts and saves it for later runs.  Watch the sign and answer each prompt.  Ignores all other arguments.  A dummy data element is required.", action="store_true")
+    parser.add_argument("--read", help="Reads from the sign instead of writing to it: text or string (the labels in data), memory (configuration), or clock.  data is required but ignored for memory and clock.", choices=['text','string','memory','clock'])
+    parser.add_argument("--sync", help="Sets the sign's time, date and day of week from this computer's clock, all in one packet timed to land on the minute.  A dummy data element is required.", action="store_true")
+    parser.add_argument("--sync-threshold", help="With --sync, only syncs if the sign's clock is estimated to be off by more than this many seconds (for running --sync from cron).", type=float)
+    parser.add_argument("--drift-rate", help="With --sync-threshold, how many seconds a day the sign's clock is assumed to drift.  Default is %g." % CLOCK_DRIFT, type=float, default=CLOCK_DRIFT)
+    parser.add_argument("--estimate", help="Instead of sending, estimates how long the sign will spend showing each TEXT label (and the whole run sequence, in a batch with setsequence).  Speeds and hold times can be tuned in display.json.", action="store_true")
+    parser.add_argument("--reconcile", help="Before sending, reads every TEXT and STRING label back from the sign so only real changes are sent.", action="store_true")
+    parser.add_argument("--verify", help="Sends with checksums and checks the sign's serial error status afterwards, resending only commands that failed.  Needs a transport that can read (USB, serial or TCP).", action="store_true")
+    parser.add_argument("--retries", help="With --verify, how many times to resend a command that failed.  Default is " + str(VERIFY_RETRIES) + ".", type=int, default=VERIFY_RETRIES)
+    parser.add_argument("--auto-memory", help="With --batch, sizes sign memory automatically from the batch's TEXT and STRING contents.  If they no longer fit the current layout, memory is reconfigured and the whole batch resent in one packet.  The batch must describe the whole sign: anything not in it is erased on reconfiguration.", action="store_true")
+    parser.add_argument("--headroom", help="With --auto-memory, the fraction of extra space given to each label.  Default is %g." % MEMORY_HEADROOM, type=float, default=MEMORY_HEADROOM)
+    parser.add_argument("--memory", help="With --auto-memory, the sign's TEXT/STRING memory in bytes.  Default is %d." % SIGN_MEMORY_TOTAL, type=int, default=SIGN_MEMORY_TOTAL)
+    parser.add_argument("--force", help="Sends TEXT, STRING and sequence updates even if the sign should already be showing them.", action="store_true")
+    parser.add_argument("--apply", help="Configures the whole sign from the manifest (JSON, or TOML ending in .toml) named in data: memory, strings, pictures, texts, run sequence and clock, all in one packet.  Only what changed is sent.  See doc.", action="store_true")
+    parser.add_argument("--emit", help="Encodes the command and writes the exact packet that would be sent to stdout, as hex or raw bytes ('bin' or '-'), without opening the sign.  No root needed.", choices=['hex','bin','-'])
+    parser.add_argument("--plan", help="Instead of sending, shows what would be sent to each sign (after skipping unchanged labels) and the bytes and time it would take.", action="store_true")
+    parser.add_argument("--batch", help="Reads commands (one command line per line, same syntax as this script's arguments) from the files named in data ('-' for stdin) and sends them all in one packet.", action="store_true")
+    parser.add_argument("--daemon", help="Runs as a resident daemon that holds the sign open and accepts commands on --socket.  Later invocations are forwarded to it automatically.  A dummy data element is required.", action="store_true")
+    parser.add_argument("--socket", help="Unix domain socket used by --daemon and its clients.  Default is " + DAEMON_SOCKET + ".", default=DAEMON_SOCKET)
+    parser.add_argument("--socket-mode", help="Permissions (octal) for the daemon's socket.  Default is 660.", default='660')
+    parser.add_argument("--queue", help="With --daemon, queues updates instead of sending each one before answering: only the newest pending update per label is sent, label 0 goes first, and --byte-rate is enforced.", action="store_true")
+    parser.add_argument("--byte-rate", help="With --daemon --queue, the most bytes per second to send to each sign.  Default is no limit.", type=int)
+    parser.add_argument("--metrics", help="Writes timings and counters (per phase, bytes, retries, failures) to this file when done: Prometheus text if it ends in .prom, otherwise appended as JSON lines.  With --daemon, it's rewritten after every request.")
+    parser.add_argument("--no-daemon", help="Talk to the sign directly even if a daemon is running.", action="store_true")
 
     parser.add_argument("data", help="The tag-formatted message data or string value to send (settext, setstring) or data supporting a special function.", nargs='+')
-    args = parser.parse_args()
+    return parser
+
+# TJBChris - Turns one parsed command into the payload(s) to send.  Returns (payloads, message), where message is
+# what to tell the user once they're sent.
+def build_payloads(args):
 
     # Following line removed to be replaced with port-less version by TJBChris.
     #transmit(args.port, write_file(parse_cmdline_messages(args.messages)))
 
     # Clear the messages and strings.
     if args.clear == True:
-        transmit(b'E$')
-        print("Memory configuration (strings, text) cleared.")
-        sys.exit()
+        return ([b'E$'], "Memory configuration (strings, text) cleared.")
 
     # Kill the priority message.
     if args.runseq == True:
-        transmit(b'\x41\x30')
-        print("Priority message (label 0) cleared.")
-        sys.exit()
+        return ([b'\x41\x30'], "Priority message (label 0) cleared.")
+
+    # Clock sync - the current time, date and day (run_command times the real thing; see sync_clock).
+    if args.sync == True:
+        return (clock_payloads(), "Clock set.")
 
     # Raw mode - allow raw data then quit, ignoring any other options.
     if args.raw == True:
         if len(args.data) < 1:
             raise Exception("Raw requires at least one data argument, which includes bytes for: Special Function Label and Special Function Data.  See Alpha Protocol manual section 6.2.")    
-        transmit(sendRaw(args.data))        
-        sys.exit()
+        return ([sendRaw(args.data)], None)
+
+    if args.auto_memory and not (args.batch or args.apply):
+        raise Exception("--auto-memory needs --batch or --apply: the batch or manifest has to describe the whole sign.")
+
+    # Manifest - the whole sign, from one file.
+    if args.apply == True:
+        if len(args.data) != 1:
+            raise Exception("--apply takes exactly one data element: the path of the manifest.")
+        return (compile_manifest(load_manifest(args.data[0]), os.path.dirname(args.data[0])), None)
+
+    # Batch mode - each data element is a full command line; everything goes out in one packet.
+    if args.batch == True:
+        payloads = []
+        for line in args.data:
+            (linePayloads, lineMessage) = build_payloads(parse_batch_line(line))
+            payloads += linePayloads
+        return (payloads, None)
 
     # Set TEXT (See BetaBrite Alpha Protocol manual for the differences between TEXT and STRING)
     if args.mode == "text":
-        transmit(write_file(parse_text_message(args.data),bytes(args.label,'utf-8')))
+        return ([list(iter_write_file(parse_text_message(args.data),bytes(args.label,'utf-8')))], None)
+
+    # Set TEXT from a sign-ready file, streamed from disk.
+    elif args.mode == "textfile":
+        if len(args.data) != 1:
+            raise Exception("textfile mode takes exactly one data element: the path of the file to send.")
+        return ([stream_text_file(args.data[0], bytes(args.label,'utf-8'))], None)
+
+    # Set a template: TEXT with {name} placeholders, each of which becomes a STRING.
+    elif args.mode == "template":
+        payloads = template_payloads(args.data, args.label)
+        return (payloads, unconfigured_fields_warning(payloads))
+
+    # Set template values (name=value), sent as STRINGs.
+    elif args.mode == "values":
+        return (value_payloads(args.data), None)
 
     # Set STRING 
     elif args.mode == "string":
-        transmit(write_string(args.data, args.label))
+        return ([write_string(args.data, args.label)], None)
+
+    # Set DOTS picture from an image file.
+    elif args.mode == "dots":
+        if len(args.data) != 1:
+            raise Exception("dots mode takes exactly one data element: the path of the picture to send.")
+        return ([write_dots(args.data[0], args.label)], None)
+
+    # Set a counter (--label 1-5) from name=value settings.
+    elif args.mode == "setcounter":
+        return ([set_counter(args.label, **parse_counter_settings(args.data))], "Counter " + args.label + " set.")
 
     # Set* modes (settime, setdate, setsequence, etc.)
     elif re.match("^set.*",args.mode):
-        transmit(parse_function(args.mode, args.data))
+        return ([parse_function(args.mode, args.data)], None)
     
     # Memory (string, text) config. functions.
     elif re.match("^cfg.*",args.mode):
-        transmit(config_mem(args.mode, args.data))
+        return ([config_mem(args.mode, args.data)], None)
 
     # I need an adult!
     else:
         raise Exception("Invalid mode received.  Was an argument added to the parser but not accounted for here?!")
+
+# TJBChris - Runs one parsed command against the sign and returns the message to show the user.  Payloads the
+# sign already has (see ShadowStore) are skipped unless --force is given.  built is build_payloads(args), if it's
+# been done already (the daemon gets it from clients that read files; see forward_to_daemon).
+def run_command(args, conn=None, shadow=None, built=None):
+    if args.read is not None:
+        return read_command(args, conn)
+    if args.estimate:
+        return estimate_command(args, built)
+    if args.sync and not args.plan:
+        return sync_command(args, conn)
+
+    (payloads, message) = built if built is not None else build_payloads(args)
+    try:
+        if shadow is None:
+            shadow = ShadowStore()
+        if args.plan:
+            return plan_command(payloads, conn, shadow, args)
+        if args.sign:
+            return fan_out(resolve_signs(args.sign), payloads, shadow, args)
+
+        addr = sign_address(args)
+        sent = send_update(payloads, conn, shadow, addr, port_sign(conn, addr), args)
+        if len(sent) == 0:
+            return "Sign already shows this; nothing sent.  Use --force to send anyway."
+        if args.batch or args.apply:
+            return describe_update(payloads, sent)
+        return message
+    finally:
+        close_payloads(payloads)
+
+# What was sent, for the user: how many commands, whether a memory layout went with them (one from the batch or
+# manifest, or a new one from --auto-memory), and how many were skipped as unchanged, if any.
+def describe_update(payloads, sent):
+    layout = any(shadow_invalidates(p) for p in sent)
+    skipped = len([p for p in payloads if not shadow_invalidates(p)]) - len([p for p in sent if not shadow_invalidates(p)])
+    if skipped > 0:
+        text = "Sent %d of %d commands in one packet (the rest were unchanged)" % (len(sent), len(sent) + skipped)
+    else:
+        text = "Sent %d commands in one packet" % len(sent)
+    if layout:
+        text += ", including a new memory layout"
+    return text + "."
+
+# --address as bytes, once it's been checked.
+def sign_address(args):
+    if not re.match(r"^[0-9A-Fa-f?]{2}$", args.address):
+        raise Exception("Sign address must be two hex digits (00 is broadcast, ? is a wildcard).  Got: " + args.address)
+    return bytes(args.address, 'latin-1')
+
+# Sends payloads to one sign, skipping what its shadow says it already has.  Returns the payloads that were sent
+# (see prepare_update).
+def send_update(payloads, conn, shadow, addr=SIGN_ADDRESS_BROADCAST, sign=SIGN_ADDRESS_BROADCAST, args=None):
+    pending = prepare_update(payloads, conn, shadow, addr, sign, args)
+    if len(pending) == 0:
+        return pending
+
+    if args is not None and args.verify:
+        transmit_verified(pending, addr, conn=conn, retries=args.retries)
+    else:
+        transmit_batch(pending, addr, conn=conn)
+    shadow.commit(pending, sign)
+    return pending
+
+# TJBChris - --emit: writes the packet transmit() would send for a command to out (a binary stream), as raw bytes or
+# as one line of hex.  With --verify that's the first packet of a verified send, error register clear included.
+# Nothing is filtered against the shadow store and nothing is sent, so the same command always emits the same
+# bytes.  Building the payloads can still save state: --mode template assigns (and saves) labels for new
+# placeholders, and --mode dots fills the picture cache.
+def emit_frame(args, out):
+    addr = sign_address(args)
+    (payloads, message) = build_payloads(args)
+    if args.verify:
+        packet = frame(checked_payloads(payloads), addr, checksummed=True)
+    else:
+        packet = frame(payloads, addr)
+    close_payloads(payloads)
+    if args.emit == 'hex':
+        out.write(packet.hex().encode('ascii') + b'\n')
+    else:
+        out.write(packet)
+    out.flush()
+
+# The payloads send_update() would actually send to a sign, after --reconcile, --auto-memory and the shadow store.
+def prepare_update(payloads, conn, shadow, addr=SIGN_ADDRESS_BROADCAST, sign=SIGN_ADDRESS_BROADCAST, args=None):
+    if args is not None and args.reconcile:
+        reconcile_shadow(shadow, addr, conn, sign)
+    if args is not None and args.auto_memory:
+        payloads = auto_memory(payloads, shadow.get_layout(sign), args.headroom, args.memory)
+    if args is not None and args.apply and not args.force:
+        payloads = skip_known_layout(payloads, shadow.get_layout(sign))
+    return shadow.filter(payloads, sign, force=args is not None and args.force)
+
+# TJBChris - --plan: what an update would send to each sign, and how long it would take on the wire, without
+# sending it.
+def plan_command(payloads, conn, shadow, args):
+    if args.sign:
+        targets = [(get_connection(t.port), t.addr, t.name) for t in resolve_signs(args.sign)]
+    else:
+        addr = sign_address(args)
+        targets = [(conn, addr, port_sign(conn, addr))]
+
+    lines = []
+    for (targetConn, addr, sign) in targets:
+        pending = prepare_update(payloads, targetConn, shadow, addr, sign, args)
+        if len(pending) == 0:
+            lines.append(shadow_sign(sign) + ": unchanged, nothing to send.")
+            continue
+        n = frame_len(pending, checksummed=args.verify)
+        pacing = targetConn.pacing if targetConn is not None else PacingProfile.load()
+        wipes = " (reconfigures memory, which erases the sign first)" if any(shadow_invalidates(p) for p in pending) else ""
+        lines.append(shadow_sign(sign) + ": %d of %d command(s), %d bytes in one packet, about %.2fs on the wire%s." % (len(pending), len(payloads), n, pacing.estimate(n), wipes))
+    return "\n".join(lines)
+
+# TJBChris - Sends the same payloads to several signs at once, each from its own thread, so updating N signs takes
+# about as long as the slowest one rather than the sum of all of them.  One sign failing doesn't stop the others;
+# failures are collected and reported together at the end.
+def fan_out(targets, payloads, shadow, args=None):
+    # Connections are created up front; get_connection() isn't meant to be raced.
+    conns = [get_connection(target.port) for target in targets]
+    results = {}
+
+    def worker(target, conn):
+        try:
+            results[target.name] = send_update(payloads, conn, shadow, target.addr, target.name, args)
+        except Exception as e:
+            results[target.name] = e
+
+    threads = [threading.Thread(target=worker, args=(target, conn), name="betabrite-" + target.name) for (target, conn) in zip(targets, conns)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    lines = []
+    failed = []
+    for target in targets:
+        result = results[target.name]
+        if isinstance(result, Exception):
+            failed.append(target.name + ": " + str(result))
+        elif len(result) == 0:
+            lines.append(target.name + ": unchanged, nothing sent.")
+        else:
+            lines.append(target.name + ": sent %d command(s)." % len(result))
+    if len(failed) > 0:
+        raise Exception("\n".join(lines + ["Failed on " + ", ".join(f.split(':')[0] for f in failed) + ":"] + failed))
+    return "\n".join(lines)
+
+# Queues one parsed command's payloads on a scheduler instead of sending them.
+def queue_command(args, scheduler, conn=None, built=None):
+    (payloads, message) = built if built is not None else build_payloads(args)
+
+    if args.sign:
+        targets = [(get_connection(t.port), t.addr, t.name) for t in resolve_signs(args.sign)]
+    else:
+        addr = sign_address(args)
+        targets = [(conn, addr, port_sign(conn, addr))]
+
+    for (targetConn, addr, sign) in targets:
+        for payload in payloads:
+            scheduler.submit(payload, targetConn, addr, sign, force=args.force)
+    return "Queued %d command(s) for %d sign(s)." % (len(payloads), len(targets))
+
+# TJBChris - --estimate: how long the sign will spend on each TEXT label, and when inserted STRINGs come up.
+def estimate_command(args, built=None):
+    (payloads, message) = built if built is not None else build_payloads(args)
+    slots = estimate_sequence(payloads)
+    if len(slots) == 0:
+        raise Exception("Nothing to estimate: --estimate needs TEXT to show (--mode text or template, or a batch with some).")
+
+    lines = []
+    for slot in slots:
+        lines.append("%s: %.1fs, starting %.1fs into the cycle" % (slot.label, slot.duration, slot.start))
+    lines.append("Full cycle: %.1fs" % sum(slot.duration for slot in slots))
+    for label in sorted(set(l for slot in slots for l in slot.strings)):
+        lines.append("String %s shows at: %s" % (label, ", ".join("%.1fs" % slot.start for slot in slots if label in slot.strings)))
+    return "\n".join(lines)
+
+# TJBChris - --sync: one sign at a time, since each waits for its own minute boundary.
+def sync_command(args, conn=None):
+    sign = None
+    if args.sign:
+        targets = resolve_signs(args.sign)
+        if len(targets) != 1:
+            raise Exception("--sync works on one sign at a time.")
+        conn = get_connection(targets[0].port)
+        addr = targets[0].addr
+        sign = targets[0].name
+    else:
+        addr = sign_address(args)
+    if conn is None:
+        conn = get_connection()
+    return sync_clock(conn, addr, sign, args.sync_threshold, args.drift_rate)
+
+# TJBChris - --read: formats what the sign reports for the user.
+def read_command(args, conn=None):
+    if args.sign:
+        targets = resolve_signs(args.sign)
+        if len(targets) != 1:
+            raise Exception("--read works on one sign at a time.")
+        conn = get_connection(targets[0].port)
+    lines = []
+    if args.read == "memory":
+        for entry in read_memory_config(conn=conn):
+            lines.append("%s %-6s %5d bytes%s" % (entry.label, entry.kind, entry.size, " (locked)" if entry.locked else ""))
+    elif args.read == "clock":
+        clock = read_clock(conn=conn)
+        lines.append("%02d:%02d %02d/%02d/%02d day %d" % (clock.hour, clock.minute, clock.month, clock.day, clock.year % 100, clock.weekday))
+    else:
+        for label in args.data:
+            if args.read == "text":
+                value = read_text(bytes(label, 'utf-8'), conn=conn)
+            else:
+                value = read_string(bytes(label, 'utf-8'), conn=conn)
+            lines.append(label + ": " + repr(value))
+    return "\n".join(lines)
+
+# Batch lines use the same syntax as the command line, minus the script name, e.g.:
+#   --mode string --label 1 42
+#   --label B [red] [hold] CPU: [str1]
+def parse_batch_line(line):
+    import shlex
+
+    args = build_parser().parse_args(shlex.split(line))
+    if args.batch or args.daemon or args.calibrate or args.read or args.reconcile or args.sign or args.estimate or args.apply or args.plan or args.emit or args.sync:
+        raise Exception("Batch lines cannot use --batch, --daemon, --calibrate, --read, --reconcile, --sign, --estimate, --apply, --plan, --emit or --sync.  Got: " + line)
+    return args
+
+# Reads batch files ('-' for stdin), skipping blank lines and # comments.
+def read_batch_lines(paths):
+    lines = []
+    for path in paths:
+        f = sys.stdin if path == '-' else open(path, 'r')
+        try:
+            for line in f:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    lines.append(line)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    if len(lines) == 0:
+        raise Exception("Batch mode needs at least one command.")
+    return lines
+
+# TJBChris - Manifests.  A manifest describes a whole sign in one file (JSON, or TOML if its name ends in .toml):
+# memory layout, STRING values, pictures, TEXT labels, run sequence and clock.  --apply compiles it with the same
+# builders as the individual modes and sends the lot in one packet over one connection, instead of the handful of
+# separate runs in the General Init Procedure.  Applying it again only sends what changed, and the memory layout
+# (which wipes the sign) is only sent when it differs from the one the sign already has.
+#
+#   {
+#     "memory":   ["t[A,255]", "t[C,255]", "s[1,100]"],
+#     "strings":  {"1": "STRING"},
+#     "texts":    {"A": "[green] [rotate] Hello from TJBChris", "C": "[amber] [rotate] String 1 is: [str1]"},
+#     "sequence": "SUAC",
+#     "counters": {"1": {"start": 100, "step": -1, "target": 0, "every": "day"}},
+#     "clock":    "now"
+#   }
+#
+# counters take set_counter()'s arguments.  clock is "now" (the computer's local time) or any of
+# {"time": "HH:MM", "date": "MM/DD/YY", "day": "1"-"7"}.
+MANIFEST_KEYS        = ('memory', 'strings', 'pictures', 'texts', 'sequence', 'counters', 'clock')
+
+def load_manifest(path):
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            manifest = tomllib.load(f)
+    else:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    if not isinstance(manifest, dict):
+        raise Exception("A manifest must be a JSON object or TOML table.  Got: " + type(manifest).__name__)
+    unknown = [key for key in manifest if key not in MANIFEST_KEYS]
+    if unknown:
+        raise Exception("Unknown manifest key(s): " + ", ".join(unknown) + ".  Valid keys are " + ", ".join(MANIFEST_KEYS) + ".")
+    return manifest
+
+# The payloads for a manifest, in the order the sign needs them: memory first, then the strings and pictures
+# the texts insert, the texts, the run sequence, the counters and the clock.  Picture paths are relative to baseDir.
+def compile_manifest(manifest, baseDir='.'):
+    payloads = []
+    if 'memory' in manifest:
+        payloads.append(config_mem('cfgmem', manifest['memory']))
+
+    def labels(section):
+        items = sorted(manifest.get(section, {}).items())
+        for (label, value) in items:
+            if len(label) != 1:
+                raise Exception("Manifest " + section + " are keyed by a one-character label.  Got: " + label)
+        return items
+
+    for (label, value) in labels('strings'):
+        payloads.append(write_string([str(value)], label))
+    for (label, path) in labels('pictures'):
+        payloads.append(write_dots(os.path.join(baseDir, path), label))
+    for (label, text) in labels('texts'):
+        tokens = text if isinstance(text, list) else [text]
+        payloads.append(list(iter_write_file(parse_text_message(tokens), bytes(label, 'utf-8'))))
+    if 'sequence' in manifest:
+        payloads.append(parse_function('setsequence', [manifest['sequence']]))
+    for (number, settings) in labels('counters'):
+        if not isinstance(settings, dict) or [key for key in settings if key not in ('start', 'step', 'target', 'every')]:
+            raise Exception("Manifest counters must be tables of start, step, target and/or every.  Got: " + repr(settings))
+        payloads.append(set_counter(number, **settings))
+
+    clock = manifest.get('clock')
+    if clock == 'now':
+        clock = clock_fields()
+    if clock is not None:
+        if not isinstance(clock, dict) or [key for key in clock if key not in ('time', 'date', 'day')]:
+            raise Exception("Manifest clock must be \"now\" or a table of time, date and/or day.  Got: " + repr(clock))
+        for key in ('time', 'date', 'day'):
+            if key in clock:
+                payloads.append(parse_function('set' + key, [str(clock[key])]))
+    return payloads
+
+# Drops a leading memory configuration when the sign already has exactly that layout, so re-applying an
+# unchanged manifest doesn't wipe the sign.
+def skip_known_layout(payloads, layout):
+    if len(payloads) > 0 and layout is not None and shadow_invalidates(payloads[0]):
+        planned = parse_memory_entries(b''.join(payload_pieces(payloads[0]))[2:])
+        if sorted(planned) == sorted(layout):
+            return payloads[1:]
+    return payloads
+
+################################################################################
+
+# TJBChris - Resident daemon.  Every CLI run used to pay for interpreter startup, the pyusb import, the libusb
+# backend and a bus enumeration before sending a single byte.  The daemon does all of that once, holds the sign
+# open, and serves the same operations as the CLI over a Unix domain socket.  The protocol is one JSON object per
+# line each way: the client sends its parsed arguments (and, for commands that read files, the payloads it built
+# from them; see reads_files), the daemon answers {"ok": ..., "message": ...}.
+# Requests are handled one at a time, so packets from different clients never interleave on the wire.
+
+# True for commands the --queue scheduler can take: plain updates.  Reads, previews (--plan, --estimate), clock
+# syncs, and updates that read the sign or plan memory first (--reconcile, --auto-memory) go through run_command.
+def queueable(args):
+    return not (args.read or args.sync or args.plan or args.estimate or args.reconcile or args.auto_memory)
+
+# Arguments that only make sense to the local process and are never forwarded.
+# The daemon always drives the sign it was started with (its own --port).
+DAEMON_LOCAL_ARGS = ('daemon', 'socket', 'socket_mode', 'no_daemon', 'calibrate', 'port', 'queue', 'byte_rate', 'metrics')
+
+#
+# With a scheduler (--queue), updates are handed to an UpdateScheduler and the client gets its answer straight
+# away.  Anything that isn't a plain update (see queueable()) is still answered directly.
+def serve_daemon(socketPath=DAEMON_SOCKET, socketMode=0o660, conn=None, scheduler=None, metricsPath=None):
+    import argparse
+    import socketserver
+
+    if conn is None:
+        conn = get_connection()
+    conn.open()
+
+    # Signs with a --sync waiting for its minute; a sign gets one at a time.
+    syncs = set()
+    syncsLock = threading.Lock()
+
+    def sync_done(target):
+        with syncsLock:
+            syncs.discard(target)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    args = daemon_args(request.get('args', {}))
+                    built = daemon_payloads(request, args)
+                    if args.sync and not args.plan:
+                        # A sync waits for the next minute boundary, so it runs on its own thread rather than
+                        # holding up every other client until then.
+                        target = sync_target(args, conn)
+                        with syncsLock:
+                            scheduled = target in syncs
+                            syncs.add(target)
+                        if scheduled:
+                            response = {'ok': True, 'message': "A clock sync is already scheduled for this sign."}
+                        else:
+                            threading.Thread(target=daemon_sync, args=(args, conn, metricsPath, lambda: sync_done(target)), name="betabrite-sync", daemon=True).start()
+                            response = {'ok': True, 'message': "The sign clock will be set at the start of the next minute."}
+                    elif scheduler is not None and queueable(args):
+                        response = {'ok': True, 'message': queue_command(args, scheduler, conn, built)}
+                    else:
+                        response = {'ok': True, 'message': run_command(args, conn, built=built)}
+                except Exception as e:
+                    response = {'ok': False, 'message': str(e)}
+                self.wfile.write(bytes(json.dumps(response) + '\n', 'utf-8'))
+                self.wfile.flush()
+                if metricsPath is not None:
+                    METRICS.write(metricsPath)
+
+    # A stale socket from a daemon that didn't shut down cleanly would stop us from binding.
+    if os.path.exists(socketPath):
+        if daemon_client(socketPath) is not None:
+            raise Exception("A betabrite daemon is already listening on " + socketPath)
+        os.unlink(socketPath)
+
+    server = socketserver.UnixStreamServer(socketPath, Handler)
+    try:
+        os.chmod(socketPath, socketMode)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if scheduler is not None:
+            scheduler.stop()
+        conn.close()
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+
+# Runs a --sync for the daemon (see serve_daemon).  The client has had its answer by now, so the outcome is logged.
+# done is called once the sync has finished, whether or not it worked.
+def daemon_sync(args, conn, metricsPath=None, done=None):
+    try:
+        print(run_command(args, conn), flush=True)
+    except Exception as e:
+        print("Clock sync failed: " + str(e), file=sys.stderr, flush=True)
+    finally:
+        if done is not None:
+            done()
+    if metricsPath is not None:
+        METRICS.write(metricsPath)
+
+# The sign a --sync is for, as the daemon tracks pending syncs: the --sign name, or the daemon's port and --address.
+def sync_target(args, conn):
+    if args.sign:
+        return ",".join(args.sign)
+    return port_sign(conn, sign_address(args))
+
+# The daemon runs as root but anyone with access to the socket can talk to it, so forwarded arguments are checked
+# the way the parser would check them: known options only, values of the right type, and within the choices.
+def daemon_args(forwarded):
+    import argparse
+
+    parser = build_parser()
+    args = parser.parse_args(['x'])
+    actions = dict((action.dest, action) for action in parser._actions)
+    for (k, v) in forwarded.items():
+        if k in DAEMON_LOCAL_ARGS:
+            continue
+        action = actions.get(k)
+        if action is None or k == 'help':
+            raise Exception("Unknown argument from client: " + k)
+        if action.nargs == 0:
+            valid = isinstance(v, bool)
+        elif action.nargs == '+' or isinstance(action, argparse._AppendAction):
+            valid = (v is None and action.nargs != '+') or (isinstance(v, list) and len(v) > 0 and all(isinstance(item, str) for item in v))
+        else:
+            kind = action.type if action.type is not None else str
+            valid = v is None or isinstance(v, kind) or (kind is float and isinstance(v, int) and not isinstance(v, bool))
+            valid = valid and (v is None or action.choices is None or v in action.choices)
+        if not valid:
+            raise Exception("Invalid value from client for " + k + ": " + repr(v))
+        setattr(args, k, v)
+    return args
+
+# True for commands that read files named in their data (textfile, dots, manifests, and batches with any of those).
+# The daemon won't open files for its clients, which could otherwise have it read anything root can; the client
+# builds these commands itself and sends the payloads.
+def reads_files(args):
+    if args.apply or args.mode in ('textfile', 'dots'):
+        return True
+    return bool(args.batch) and any(reads_files(parse_batch_line(line)) for line in args.data)
+
+# The (payloads, message) a client built for a command that reads files, or None for anything else.
+def daemon_payloads(request, args):
+    if 'payloads' not in request:
+        if reads_files(args):
+            raise Exception("The daemon doesn't read files for clients; send the command's payloads instead.")
+        return None
+    payloads = request['payloads']
+    message = request.get('message')
+    if not isinstance(payloads, list) or not all(isinstance(p, str) for p in payloads) or not (message is None or isinstance(message, str)):
+        raise Exception("Invalid payloads from client.")
+    return ([bytes(p, 'latin-1') for p in payloads], message)
+
+# Returns a connected socket to a running daemon, or None if there isn't one.
+def daemon_client(socketPath=DAEMON_SOCKET):
+    import socket
+
+    if not os.path.exists(socketPath):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+# Forwards parsed arguments to the daemon.  Returns (handled, message); handled is False if no daemon answered.
+def forward_to_daemon(args, socketPath=DAEMON_SOCKET):
+    sock = daemon_client(socketPath)
+    if sock is None:
+        return (False, None)
+
+    request = {'args': {k: v for k, v in vars(args).items() if k not in DAEMON_LOCAL_ARGS}}
+    if reads_files(args):
+        (payloads, message) = build_payloads(args)
+        request['payloads'] = [b''.join(payload_pieces(p)).decode('latin-1') for p in payloads]
+        request['message'] = message
+        close_payloads(payloads)
+    with sock:
+        sock.sendall(bytes(json.dumps(request) + '\n', 'utf-8'))
+        with sock.makefile('r') as f:
+            line = f.readline()
+
+    if not line:
+        raise Exception("The betabrite daemon closed the connection without answering.")
+    response = json.loads(line)
+    if not response['ok']:
+        raise Exception(response['message'])
+    return (True, response['message'])
+
+if __name__ == '__main__':
+
+    args = build_parser().parse_args()
+
+    # Find and save the fastest pacing this sign accepts.
+    if args.calibrate == True:
+        profile = calibrate_pacing(get_connection(args.port))
+        print("Pacing calibrated and saved: %r" % profile)
+        sys.exit()
+
+    # Sign registry management.
+    if args.list_signs == True:
+        for sign in find_signs():
+            print("attached  %-24s serial=%s" % (sign['port'], sign['serial']))
+        for sign in load_signs().values():
+            print("%-9s %-24s address=%s" % (sign.name, sign.port, sign.addr.decode('latin-1')))
+        sys.exit()
+
+    if args.register is not None:
+        register_sign(args.register, args.port, bytes(args.address, 'latin-1'))
+        print("Registered sign '%s' at %s (address %s)." % (args.register, args.port, args.address))
+        sys.exit()
+
+    # Hold the sign open and serve other invocations until killed.
+    if args.daemon == True:
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            scheduler = UpdateScheduler(byteRate=args.byte_rate, verify=args.verify, retries=args.retries) if args.queue else None
+            serve_daemon(args.socket, int(args.socket_mode, 8), get_connection(args.port), scheduler, args.metrics)
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    # The daemon may not share our working directory.
+    if args.mode in ("textfile", "dots") or args.apply:
+        args.data = [os.path.abspath(d) for d in args.data]
+
+    # Batch files are read here so a daemon gets the commands themselves rather than our file names.
+    if args.batch == True:
+        args.data = read_batch_lines(args.data)
+
+    # Encode only: the packet goes to stdout, and neither the sign nor a daemon is involved.
+    if args.emit is not None:
+        emit_frame(args, sys.stdout.buffer)
+        sys.exit()
+
+    # If a daemon is running, let it do the work; otherwise talk to the sign ourselves.
+    handled = False
+    if not args.no_daemon:
+        (handled, message) = forward_to_daemon(args, args.socket)
+    if not handled:
+        try:
+            message = run_command(args, get_connection(args.port))
+        finally:
+            if args.metrics is not None:
+                METRICS.write(args.metrics)
+
+    if message is not None:
+        print(message)